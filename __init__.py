@@ -4,13 +4,24 @@
 # the full copyright notices and license terms.
 from trytond.pool import Pool
 from .template import *
+from .job import *
+from .bulk import *
+from .stats import *
+from .electronic_mail import *
 from .trigger import *
 from .report import *
+from .activity import *
 
 def register():
     Pool.register(
         ActionReport,
         Template,
         TemplateReport,
+        TemplateCompiled,
+        TemplateJob,
+        TemplateBulk,
+        TemplateStats,
+        ElectronicMail,
         Trigger,
+        ActivityReference,
         module='electronic_mail_template', type_='model')
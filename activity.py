@@ -0,0 +1,35 @@
+# This file is part electronic_mail_template module for Tryton.
+# The COPYRIGHT file at the top level of this repository contains
+# the full copyright notices and license terms.
+from trytond.pool import Pool, PoolMeta
+
+__all__ = ['ActivityReference']
+
+
+class ActivityReference:
+    '''Clears the activity reference models cached by the email templates
+
+    Only added to the pool when the activity module is installed.
+    '''
+    __metaclass__ = PoolMeta
+    __name__ = 'activity.reference'
+
+    @staticmethod
+    def _clear_template_cache():
+        Template = Pool().get('electronic.mail.template')
+        Template._activity_reference_cache.clear()
+
+    @classmethod
+    def create(cls, vlist):
+        cls._clear_template_cache()
+        return super(ActivityReference, cls).create(vlist)
+
+    @classmethod
+    def write(cls, *args):
+        cls._clear_template_cache()
+        super(ActivityReference, cls).write(*args)
+
+    @classmethod
+    def delete(cls, references):
+        cls._clear_template_cache()
+        super(ActivityReference, cls).delete(references)
@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+# This file is part electronic_mail_template module for Tryton.
+# The COPYRIGHT file at the top level of this repository contains
+# the full copyright notices and license terms.
+"""Reports executed per record and with execute_many
+
+Renders the reports of a batch of groups with the BatchReport of the tests,
+whose executions each take --overhead milliseconds, once per record with
+render_reports and once per chunk with render_reports_many, on a SQLite
+memory database:
+
+    python benchmarks/batched_reports.py --records 100 --records 1000
+"""
+import argparse
+import os
+import time
+
+
+def run(counts, overhead):
+    os.environ.setdefault('TRYTOND_DATABASE_URI', 'sqlite://')
+    os.environ.setdefault('DB_NAME', ':memory:')
+    from trytond.tests import test_tryton
+    from trytond.tests.test_tryton import DB_NAME, USER, CONTEXT
+    from trytond.config import config
+    from trytond.pool import Pool
+    from trytond.transaction import Transaction
+    from trytond.modules.electronic_mail_template.tests.\
+        test_electronic_mail_template import BatchReport, add_batch_report
+
+    activate = getattr(test_tryton, 'activate_module', None) or getattr(
+        test_tryton, 'install_module')
+    activate('electronic_mail_template')
+    chunk_size = config.getint('electronic_mail_template', 'chunk_size',
+        default=100)
+
+    BatchReport.overhead = overhead / 1000.
+    with Transaction().start(DB_NAME, USER, context=CONTEXT):
+        pool = Pool()
+        Model = pool.get('ir.model')
+        Group = pool.get('res.group')
+        Template = pool.get('electronic.mail.template')
+
+        action, remove = add_batch_report('res.group')
+        model, = Model.search([('model', '=', 'res.group')])
+        template, = Template.create([{
+                    'name': 'Benchmark',
+                    'model': model.id,
+                    'from_': 'bench@example.com',
+                    'reports': [('add', [action.id])],
+                    }])
+        groups = Group.create([{
+                    'name': 'Benchmark %s' % i,
+                    } for i in range(max(counts))])
+        for count in counts:
+            records = groups[:count]
+            BatchReport.calls = []
+            start = time.time()
+            for record in records:
+                template.render_reports(record)
+            per_record = time.time() - start
+            calls = len(BatchReport.calls)
+
+            BatchReport.calls = []
+            start = time.time()
+            for i in range(0, len(records), chunk_size):
+                template.render_reports_many(records[i:i + chunk_size])
+            batched = time.time() - start
+            print('%5s records: per record %8.3f s (%s calls), '
+                'execute_many %8.3f s (%s calls)' % (count, per_record,
+                    calls, batched, len(BatchReport.calls)))
+        remove()
+        Transaction().rollback()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--records', type=int, action='append')
+    parser.add_argument('--overhead', type=float, default=5,
+        help='milliseconds spent by each report execution')
+    args = parser.parse_args()
+    run(args.records or [100, 1000], args.overhead)
+
+
+if __name__ == '__main__':
+    main()
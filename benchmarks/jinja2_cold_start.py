@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+# This file is part electronic_mail_template module for Tryton.
+# The COPYRIGHT file at the top level of this repository contains
+# the full copyright notices and license terms.
+"""First render latency of Jinja2 email templates after a process start
+
+A first process creates the email templates in a SQLite database of a
+temporary directory. Then each mode runs in a new process, as a worker after
+a restart, and reports the time to load through the Jinja2 engine of the
+module, compile_field, and render the html field of every template once
+(cold) and again (warm):
+
+    python benchmarks/jinja2_cold_start.py --templates 50
+
+``compile`` empties the bytecode cache of the module first so every template
+is parsed, ``bytecode`` loads them from the bytecode cache filled when the
+templates were saved.
+"""
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+BODY = u'''
+<p>Dear {{ record.name }},</p>
+{% for i in range(20) %}
+<tr>
+  <td>{{ loop.index }}</td>
+  <td>{{ record.login|e }}</td>
+  <td>{{ '%.2f'|format(i * 10.) }}</td>
+  {% if i > 10 %}<td>{{ i * 0.21 }}</td>{% endif %}
+</tr>
+{% endfor %}
+<p>{{ record.name|length }}</p>
+'''
+
+
+def start(directory):
+    os.environ.setdefault('TRYTOND_DATABASE_URI', 'sqlite://')
+    os.environ.setdefault('DB_NAME', 'jinja2_cold_start')
+    from trytond.config import config
+    config.set('database', 'path', directory)
+
+
+def setup(templates, directory):
+    start(directory)
+    from trytond.tests import test_tryton
+    from trytond.tests.test_tryton import DB_NAME, USER, CONTEXT
+    from trytond.pool import Pool
+    from trytond.transaction import Transaction
+
+    activate = getattr(test_tryton, 'activate_module', None) or getattr(
+        test_tryton, 'install_module')
+    activate('electronic_mail_template')
+    with Transaction().start(DB_NAME, USER, context=CONTEXT) as transaction:
+        pool = Pool()
+        Model = pool.get('ir.model')
+        Template = pool.get('electronic.mail.template')
+
+        model, = Model.search([('model', '=', 'res.user')])
+        Template.create([{
+                    'name': 'Benchmark %s' % i,
+                    'model': model.id,
+                    'engine': 'jinja2',
+                    'from_': 'bench@example.com',
+                    'html': BODY * 5,
+                    } for i in range(templates)])
+        transaction.commit()
+
+
+def run(mode, directory):
+    start(directory)
+    from trytond.tests.test_tryton import DB_NAME, USER, CONTEXT
+    from trytond.pool import Pool
+    from trytond.transaction import Transaction
+    from trytond.modules.electronic_mail_template.engine import get_engine
+
+    Pool.start()
+    Pool(DB_NAME).init()
+    engine = get_engine('jinja2')
+    if mode == 'compile':
+        shutil.rmtree(engine.environment.bytecode_cache.directory)
+        os.makedirs(engine.environment.bytecode_cache.directory)
+    with Transaction().start(DB_NAME, USER, context=CONTEXT):
+        pool = Pool()
+        Template = pool.get('electronic.mail.template')
+        User = pool.get('res.user')
+
+        templates = Template.search([('engine', '=', 'jinja2')])
+        admin, = User.search([('login', '=', 'admin')])
+        timings = []
+        for _ in range(2):
+            start_time = time.time()
+            for template in templates:
+                compiled = engine.compile_field(template, 'html')
+                engine.render(compiled, Template.template_context(admin))
+            timings.append((time.time() - start_time) * 1000 / len(templates))
+    print('%s: cold %.3f ms, warm %.3f ms per template' % (
+            mode, timings[0], timings[1]))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--templates', type=int, default=50)
+    parser.add_argument('--mode', choices=['setup', 'compile', 'bytecode'])
+    parser.add_argument('--directory')
+    args = parser.parse_args()
+    if args.mode == 'setup':
+        setup(args.templates, args.directory)
+        return
+    elif args.mode:
+        run(args.mode, args.directory)
+        return
+    directory = tempfile.mkdtemp()
+    try:
+        command = [sys.executable, __file__, '--templates',
+            str(args.templates), '--directory', directory]
+        subprocess.check_call(command + ['--mode', 'setup'])
+        subprocess.check_call(command + ['--mode', 'bytecode'])
+        subprocess.check_call(command + ['--mode', 'compile'])
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+# This file is part electronic_mail_template module for Tryton.
+# The COPYRIGHT file at the top level of this repository contains
+# the full copyright notices and license terms.
+"""Peak memory of in memory and streaming MIME generation
+
+Each mode runs in its own process and reports its peak RSS for a message
+with one attachment of the given size:
+
+    python benchmarks/streaming.py --size 40
+"""
+import argparse
+import os
+import resource
+import subprocess
+import sys
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+
+
+def message():
+    message = MIMEMultipart()
+    message['subject'] = 'Benchmark'
+    body = MIMEMultipart('alternative')
+    body.attach(MIMEText('Body', _charset='utf-8'))
+    body.attach(MIMEText('<p>Body</p>', 'html', _charset='utf-8'))
+    return message, body
+
+
+def run(mode, size):
+    from trytond.modules.electronic_mail_template.template import Template
+
+    data = os.urandom(size * 1024 * 1024)
+    baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    msg, body = message()
+    if mode == 'memory':
+        attachment = Template.attachment_part('report.pdf', data)
+        attachment.add_header('Content-Transfer-Encoding', 'base64')
+        msg.attach(attachment)
+        msg.attach(body)
+        with open(os.devnull, 'w') as f:
+            f.write(msg.as_string())
+    else:
+        msg.attach(body)
+        fileobj = Template.write_message(msg, [('report.pdf', data)])
+        fileobj.close()
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in kilobytes on Linux
+    print('%s: %.1f MB over the attachment data' % (
+            mode, (peak - baseline) / 1024.))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--size', type=int, default=40,
+        help='attachment size in megabytes')
+    parser.add_argument('--mode', choices=['memory', 'stream'])
+    args = parser.parse_args()
+    if args.mode:
+        run(args.mode, args.size)
+        return
+    for mode in ('memory', 'stream'):
+        subprocess.check_call([sys.executable, __file__,
+                '--mode', mode, '--size', str(args.size)])
+
+
+if __name__ == '__main__':
+    main()
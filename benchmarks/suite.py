@@ -0,0 +1,286 @@
+#!/usr/bin/env python
+# This file is part electronic_mail_template module for Tryton.
+# The COPYRIGHT file at the top level of this repository contains
+# the full copyright notices and license terms.
+"""Rendering and sending throughput of the email templates
+
+Each scenario, an engine with or without reports, style, signature and
+activities, runs in its own process on a SQLite memory database with the
+party module (and activity, if installed) and sends to a local SMTP sink.
+For render, render_and_send and get_attachments it measures the records per
+second, the p50 and p99 latency per message and the peak memory over the
+setup, each operation running in its own process as the peak never goes
+down:
+
+    python benchmarks/suite.py --records 200 --output results.json
+    python benchmarks/suite.py --compare before.json results.json
+
+render_and_send is timed once per record, as sent by a trigger, and the
+records per second are those of one batch of all the records.
+"""
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+
+ENGINES = ('python', 'genshi', 'jinja2')
+OPTIONS = ('reports', 'style', 'signature', 'activities')
+OPERATIONS = ('render', 'render_and_send', 'get_attachments')
+
+LINES = 20
+EXPRESSIONS = {
+    'python': {
+        'from_': '"bench@example.com"',
+        'to': '"party%s@example.com" % record.id',
+        'subject': '"Statement of %s" % record.name',
+        'plain': '"Dear %s,\\n\\n" % record.name + "".join('
+            '"Line %s: %s\\n" % (i, record.code) for i in range(' +
+            str(LINES) + '))',
+        'html': '"<p>Dear %s,</p><table>" % record.name + "".join('
+            '"<tr><td>%s</td><td>%s</td></tr>" % (i, record.code) '
+            'for i in range(' + str(LINES) + ')) + "</table>"',
+        'activity': 'record.id',
+        },
+    'genshi': {
+        'from_': 'bench@example.com',
+        'to': 'party${record.id}@example.com',
+        'subject': 'Statement of ${record.name}',
+        'plain': 'Dear ${record.name},\n\n'
+            '#for i in range(' + str(LINES) + ')\n'
+            'Line ${i}: ${record.code}\n#end\n',
+        'html': '<p>Dear ${record.name},</p><table>\n'
+            '#for i in range(' + str(LINES) + ')\n'
+            '<tr><td>${i}</td><td>${record.code}</td></tr>\n#end\n</table>',
+        'activity': '${record.id}',
+        },
+    'jinja2': {
+        'from_': 'bench@example.com',
+        'to': 'party{{ record.id }}@example.com',
+        'subject': 'Statement of {{ record.name }}',
+        'plain': 'Dear {{ record.name }},\n\n'
+            '{% for i in range(' + str(LINES) + ') %}'
+            'Line {{ i }}: {{ record.code }}\n{% endfor %}',
+        'html': '<p>Dear {{ record.name }},</p><table>'
+            '{% for i in range(' + str(LINES) + ') %}'
+            '<tr><td>{{ i }}</td><td>{{ record.code }}</td></tr>'
+            '{% endfor %}</table>',
+        'activity': '{{ record.id }}',
+        },
+    }
+
+
+def scenarios():
+    yield 'base'
+    for option in OPTIONS:
+        yield option
+
+
+def percentile(values, percent):
+    values = sorted(values)
+    if not values:
+        return None
+    index = min(len(values) - 1, int(round(percent / 100. * len(values))))
+    return values[index]
+
+
+def peak_rss():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+
+
+def summarize(operation, latencies, duration, count, rss):
+    return {
+        'operation': operation,
+        'records_per_second': round(count / duration, 2) if duration else None,
+        'p50_ms': round(percentile(latencies, 50) * 1000, 3),
+        'p99_ms': round(percentile(latencies, 99) * 1000, 3),
+        'peak_rss_mb': round(rss, 1),
+        }
+
+
+def setup(engine, scenario, count, port):
+    from trytond.pool import Pool
+    from trytond.transaction import Transaction
+
+    pool = Pool()
+    Model = pool.get('ir.model')
+    Party = pool.get('party.party')
+    Mailbox = pool.get('electronic.mail.mailbox')
+    SMTPServer = pool.get('smtp.server')
+    Template = pool.get('electronic.mail.template')
+    ActionReport = pool.get('ir.action.report')
+    User = pool.get('res.user')
+
+    model, = Model.search([('model', '=', 'party.party')])
+    mail_model, = Model.search([('model', '=', 'electronic.mail')])
+    SMTPServer.create([{
+                'name': 'Sink',
+                'smtp_server': '127.0.0.1',
+                'smtp_port': port,
+                'smtp_email': 'bench@example.com',
+                'default': True,
+                'models': [('add', [mail_model.id])],
+                }])
+    mailbox, = Mailbox.create([{'name': 'Benchmark'}])
+
+    values = dict(EXPRESSIONS[engine])
+    if scenario != 'activities':
+        del values['activity']
+    values.update({
+            'name': 'Benchmark %s %s' % (engine, scenario),
+            'model': model.id,
+            'engine': engine,
+            'mailbox': mailbox.id,
+            })
+    if scenario == 'reports':
+        reports = ActionReport.search([('report_name', '=', 'party.label')])
+        values['reports'] = [('add', [r.id for r in reports])]
+    elif scenario == 'style':
+        values['style'] = 'simples.css'
+        values['custom_style'] = 'td {padding: 2px;}'
+    elif scenario == 'signature':
+        values['signature'] = True
+        admin = User(Transaction().user)
+        User.write([admin], {
+                'signature': 'Regards,\nThe benchmark',
+                })
+    template, = Template.create([values])
+    parties = Party.create([{
+                'name': 'Party %s' % i,
+                } for i in range(count)])
+    return template, parties
+
+
+def run(engine, scenario, operation, count):
+    os.environ.setdefault('TRYTOND_DATABASE_URI', 'sqlite://')
+    os.environ.setdefault('DB_NAME', ':memory:')
+    from trytond.tests import test_tryton
+    from trytond.tests.test_tryton import DB_NAME, USER, CONTEXT
+    from trytond.transaction import Transaction
+    from trytond.modules.electronic_mail_template.tests.\
+        test_electronic_mail_template import SMTPSink
+
+    activate = getattr(test_tryton, 'activate_module', None) or getattr(
+        test_tryton, 'install_module')
+    activate('party')
+    if scenario == 'activities':
+        activate('activity')
+    activate('electronic_mail_template')
+
+    sink = SMTPSink()
+    try:
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            template, parties = setup(engine, scenario, count, sink.port)
+            baseline = peak_rss()
+            method = getattr(template, operation)
+            latencies = []
+            start = time.time()
+            for party in parties:
+                message_start = time.time()
+                if operation == 'render':
+                    method(party)
+                else:
+                    method([party])
+                latencies.append(time.time() - message_start)
+            duration = time.time() - start
+            if operation == 'render_and_send':
+                start = time.time()
+                template.render_and_send(parties)
+                duration = time.time() - start
+            result = summarize(operation, latencies, duration,
+                len(parties), peak_rss() - baseline)
+            Transaction().rollback()
+    finally:
+        sink.stop()
+    result.update({
+            'engine': engine,
+            'scenario': scenario,
+            'messages_received': len(sink.messages),
+            })
+    json.dump(result, sys.stdout)
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.STDOUT).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(before, after):
+    def key(result):
+        return (result['engine'], result['scenario'], result['operation'])
+    previous = dict((key(r), r) for r in before['results'])
+    print('%-8s %-11s %-16s %10s %10s %10s' % ('engine', 'scenario',
+            'operation', 'rec/s', 'p99', 'rss'))
+    for result in after['results']:
+        old = previous.get(key(result))
+        if not old:
+            continue
+
+        def change(name):
+            if not old[name] or result[name] is None:
+                return '-'
+            return '%+.1f%%' % ((result[name] - old[name]) * 100. / old[name])
+        print('%-8s %-11s %-16s %10s %10s %10s' % (key(result) + (
+                    change('records_per_second'), change('p99_ms'),
+                    change('peak_rss_mb'))))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--records', type=int, default=200)
+    parser.add_argument('--engine', choices=ENGINES, action='append')
+    parser.add_argument('--scenario', choices=list(scenarios()),
+        action='append')
+    parser.add_argument('--output', help='JSON file of the results')
+    parser.add_argument('--compare', nargs=2, metavar=('BEFORE', 'AFTER'),
+        help='compare two JSON result files')
+    parser.add_argument('--run', nargs=3,
+        metavar=('ENGINE', 'SCENARIO', 'OPERATION'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run:
+        run(args.run[0], args.run[1], args.run[2], args.records)
+        return
+    if args.compare:
+        with open(args.compare[0]) as f:
+            before = json.load(f)
+        with open(args.compare[1]) as f:
+            after = json.load(f)
+        compare(before, after)
+        return
+
+    results = []
+    for engine in args.engine or ENGINES:
+        for scenario in args.scenario or scenarios():
+            for operation in OPERATIONS:
+                if operation == 'get_attachments' and scenario != 'reports':
+                    continue
+                output = subprocess.check_output([sys.executable, __file__,
+                        '--records', str(args.records),
+                        '--run', engine, scenario, operation])
+                result = json.loads(output.decode('utf-8'))
+                print('%(engine)-8s %(scenario)-11s %(operation)-16s '
+                    '%(records_per_second)8s rec/s  p50 %(p50_ms)8s ms  '
+                    'p99 %(p99_ms)8s ms  %(peak_rss_mb)6s MB' % result)
+                results.append(result)
+    data = {
+        'revision': git_revision(),
+        'python': sys.version.split()[0],
+        'records': args.records,
+        'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'results': results,
+        }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(data, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
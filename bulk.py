@@ -0,0 +1,179 @@
+# This file is part electronic_mail_template module for Tryton.
+# The COPYRIGHT file at the top level of this repository contains
+# the full copyright notices and license terms.
+import logging
+from itertools import islice
+
+from trytond.config import config
+from trytond.model import ModelView, ModelSQL, fields
+from trytond.pyson import Eval, PYSONEncoder, PYSONDecoder
+from trytond.transaction import Transaction
+from trytond.pool import Pool
+
+__all__ = ['TemplateBulk']
+
+logger = logging.getLogger(__name__)
+
+
+class TemplateBulk(ModelSQL, ModelView):
+    'Email Template Bulk Send'
+    __name__ = 'electronic.mail.template.bulk'
+
+    template = fields.Many2One('electronic.mail.template', 'Template',
+        required=True, ondelete='CASCADE', select=True, readonly=True)
+    domain = fields.Text('Domain', readonly=True,
+        help='The records to send, empty when they are given by ids')
+    state = fields.Selection([
+            ('running', 'Running'),
+            ('done', 'Done'),
+            ], 'State', required=True, select=True, readonly=True)
+    position = fields.Integer('Position', readonly=True,
+        help='Number of records processed')
+    last_id = fields.Integer('Last ID', readonly=True,
+        help='Highest record ID processed')
+    sent = fields.Integer('Sent', readonly=True)
+    failed = fields.Integer('Failed', readonly=True)
+
+    @classmethod
+    def __setup__(cls):
+        super(TemplateBulk, cls).__setup__()
+        cls._order.insert(0, ('id', 'DESC'))
+        cls._buttons.update({
+                'resume': {
+                    'invisible': ((Eval('state') != 'running')
+                        | ~Eval('domain')),
+                    },
+                })
+
+    @staticmethod
+    def default_state():
+        return 'running'
+
+    @staticmethod
+    def default_position():
+        return 0
+
+    @staticmethod
+    def default_last_id():
+        return 0
+
+    @staticmethod
+    def default_sent():
+        return 0
+
+    @staticmethod
+    def default_failed():
+        return 0
+
+    @classmethod
+    def start(cls, template, domain=None, ids=None):
+        '''Records the checkpoint of a bulk send and runs it
+
+        The checkpoint is committed with the pending changes of the
+        transaction, unless the context has _email_template_commit set to
+        False.
+
+        :param template: Template instance
+        :param domain: Domain of the records to send
+        :param ids: Iterator of the ids of the records to send, used instead
+            of the domain
+        '''
+        bulk, = cls.create([{
+                    'template': template.id,
+                    'domain': (PYSONEncoder().encode(domain or [])
+                        if ids is None else None),
+                    }])
+        cls.commit()
+        bulk.run(ids)
+        return bulk
+
+    @staticmethod
+    def commit():
+        'Commits the transaction unless _email_template_commit is False'
+        transaction = Transaction()
+        if transaction.context.get('_email_template_commit', True):
+            transaction.commit()
+
+    @classmethod
+    @ModelView.button
+    def resume(cls, bulks):
+        for bulk in bulks:
+            if bulk.state == 'running' and bulk.domain:
+                bulk.run()
+
+    def run(self, ids=None, chunk_size=None):
+        '''Renders and sends the records from the checkpoint, chunk by chunk
+
+        Each chunk is committed with the checkpoint so an interrupted run
+        resumes after the last chunk committed, unless the context has
+        _email_template_commit set to False. The records of a domain are
+        processed by ascending id, the ids are skipped up to the position.
+        The records of a failing chunk are rendered one by one, those that
+        fail are logged and skipped, and the others sent again. If none of
+        them fails to render, the chunk is left to the deferred jobs.
+        '''
+        pool = Pool()
+        Model = pool.get(self.template.model.model)
+        transaction = Transaction()
+
+        if chunk_size is None:
+            chunk_size = config.getint('electronic_mail_template',
+                'chunk_size', default=100)
+        template = self.template
+        position, last_id = self.position or 0, self.last_id or 0
+        sent, failed = self.sent or 0, self.failed or 0
+        if ids is None:
+            domain = PYSONDecoder().decode(self.domain or '[]')
+        else:
+            ids = islice(iter(ids), position, None)
+
+        while True:
+            if ids is None:
+                records = Model.search(domain + [('id', '>', last_id)],
+                    order=[('id', 'ASC')], limit=chunk_size)
+                count = len(records)
+            else:
+                chunk_ids = list(islice(ids, chunk_size))
+                count = len(chunk_ids)
+                with transaction.set_context(active_test=False):
+                    records = Model.search([('id', 'in', chunk_ids)])
+                order = dict((id_, i) for i, id_ in enumerate(chunk_ids))
+                records.sort(key=lambda r: order[r.id])
+            if not count:
+                break
+            failed_records = self.send_chunk(template, records)
+            position += count
+            last_id = max([last_id] + [r.id for r in records])
+            failed += len(failed_records)
+            sent += len(records) - len(failed_records)
+            self.write([self], {
+                    'position': position,
+                    'last_id': last_id,
+                    'sent': sent,
+                    'failed': failed,
+                    })
+            self.commit()
+            logger.info('Email template bulk %s: %s records processed, '
+                '%s failed', self.id, position, failed)
+        self.write([self], {
+                'state': 'done',
+                })
+        self.commit()
+
+    @classmethod
+    def send_chunk(cls, template, records):
+        '''Sends the records and returns the list of those that failed, which
+        are recorded as jobs to retry later unless quarantined
+
+        The records that fail, to render or to be sent, are isolated by
+        Template.render_and_send_each, the records already sent are not
+        sent again.
+        '''
+        Job = Pool().get('electronic.mail.template.job')
+
+        quarantined, errors = template.render_and_send_each(records)
+        failed = [r for r in records if r.id in errors]
+        jobs = Job.create_from_records(template, failed)
+        for job, record in zip(jobs, failed):
+            Job.postpone([job], errors[record.id])
+        return failed + quarantined
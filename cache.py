@@ -0,0 +1,122 @@
+# This file is part electronic_mail_template module for Tryton.
+# The COPYRIGHT file at the top level of this repository contains
+# the full copyright notices and license terms.
+import hashlib
+import os
+import tempfile
+from threading import Lock
+
+from trytond.cache import Cache
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+__all__ = ['CountedCache', 'FileCache']
+
+
+class CountedCache(Cache):
+    """
+    A Tryton LRU cache that keeps hit and miss counters.
+    """
+    _missing = object()
+
+    def __init__(self, name, size_limit=1024, context=True):
+        super(CountedCache, self).__init__(name, size_limit=size_limit,
+            context=context)
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        result = super(CountedCache, self).get(key, self._missing)
+        if result is self._missing:
+            self.misses += 1
+            return default
+        self.hits += 1
+        return result
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'size_limit': self.size_limit,
+            }
+
+    def reset_stats(self):
+        self.hits = 0
+        self.misses = 0
+
+
+class FileCache(object):
+    """
+    A key value cache stored in a directory with a size limit in bytes.
+    The least recently used entries are removed when the limit is reached.
+    """
+
+    def __init__(self, directory, size_limit):
+        self.directory = directory
+        self.size_limit = size_limit
+        self.hits = 0
+        self.misses = 0
+        self._size = None
+        self._lock = Lock()
+
+    def _path(self, key):
+        return os.path.join(self.directory,
+            hashlib.sha1(repr(key).encode('utf-8')).hexdigest())
+
+    def get(self, key, default=None):
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                value = pickle.load(f)
+            os.utime(path, None)
+        except (IOError, OSError, EOFError, pickle.UnpicklingError):
+            self.misses += 1
+            return default
+        self.hits += 1
+        return value
+
+    def set(self, key, value):
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, prefix='.')
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump(value, f, pickle.HIGHEST_PROTOCOL)
+        size = os.path.getsize(tmp_path)
+        os.rename(tmp_path, self._path(key))
+        with self._lock:
+            if self._size is not None:
+                self._size += size
+            if self._size is None or self._size > self.size_limit:
+                self._evict()
+        return value
+
+    def _evict(self):
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.startswith('.'):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.directory, name))
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, name))
+        entries.sort()
+        size = sum(e[1] for e in entries)
+        while entries and size > self.size_limit:
+            _, entry_size, name = entries.pop(0)
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except OSError:
+                pass
+            size -= entry_size
+        self._size = size
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'size_limit': self.size_limit,
+            }
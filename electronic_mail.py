@@ -0,0 +1,261 @@
+# This file is part electronic_mail_template module for Tryton.
+# The COPYRIGHT file at the top level of this repository contains
+# the full copyright notices and license terms.
+import datetime
+import hashlib
+import json
+import logging
+import time
+from email import message_from_string
+from email.header import decode_header
+from email.utils import getaddresses, mktime_tz, parseaddr, parsedate_tz
+
+from trytond.config import config
+from trytond.model import fields
+from trytond.pool import Pool, PoolMeta
+from trytond.transaction import Transaction
+
+from .outbox import OutboxDrain, relay_option, smtp_connector
+from .recipients import normalize_recipients
+
+__all__ = ['ElectronicMail']
+
+logger = logging.getLogger(__name__)
+# The fields of the values of a mail missing in some electronic_mail versions
+OPTIONAL_FIELDS = ('sender', 'reply_to', 'in_reply_to', 'digest', 'size')
+
+
+def _decode_header(value):
+    'Returns the header value as unicode'
+    if not value:
+        return None
+    return u''.join(part.decode(charset or 'utf-8', 'replace')
+        if isinstance(part, bytes) else part
+        for part, charset in decode_header(value))
+
+
+class ElectronicMail:
+    __metaclass__ = PoolMeta
+    __name__ = 'electronic.mail'
+    outbox_error = fields.Text('Outbox Error', readonly=True,
+        help='The error of the relay that refused the queued mail')
+
+    @classmethod
+    def __setup__(cls):
+        super(ElectronicMail, cls).__setup__()
+        cls._error_messages.update({
+                'invalid_addresses': ('Invalid addresses of the mail '
+                    '"%(subject)s": %(addresses)s'),
+                })
+
+    @classmethod
+    def create_from_emails(cls, mails, mailbox, contexts=None):
+        '''Creates the mail records of a chunk of email messages with a
+        single create
+
+        :param mails: List of email objects
+        :param mailbox: Mailbox of the mails
+        :param contexts: List of dictionaries, one per mail, with the bcc
+        :return: List of the created mails
+        '''
+        if contexts is None:
+            contexts = [{}] * len(mails)
+        return cls.create([cls.get_values_from_email(mail, mailbox, context)
+                for mail, context in zip(mails, contexts)])
+
+    @classmethod
+    def get_values_from_email(cls, mail, mailbox, context=None):
+        '''Returns the values to create the record of the email message, as
+        create_from_email stores them
+
+        The electronic_mail module has no hook for these values, so they are
+        checked against the model: the optional header fields it does not
+        have are left out and the required fields must all be given. The
+        recipients must be valid addresses.
+        '''
+        if context is None:
+            context = {}
+        data = mail.as_string()
+        date = None
+        parsed = mail.get('date') and parsedate_tz(mail['date'])
+        if parsed:
+            date = datetime.datetime.fromtimestamp(mktime_tz(parsed))
+        values = {
+            'mailbox': mailbox.id,
+            'from_': _decode_header(mail.get('from')),
+            'sender': _decode_header(mail.get('sender')),
+            'to': _decode_header(mail.get('to')),
+            'cc': _decode_header(mail.get('cc')),
+            'bcc': context.get('bcc'),
+            'reply_to': _decode_header(mail.get('reply-to')),
+            'subject': _decode_header(mail.get('subject')),
+            'date': date,
+            'message_id': mail.get('message-id'),
+            'in_reply_to': mail.get('in-reply-to'),
+            'digest': hashlib.md5(data).hexdigest(),
+            'size': len(data),
+            'mail_file': data,
+            }
+        invalid = normalize_recipients(values['to'], values['cc'],
+            values['bcc'])[-1]
+        if invalid:
+            cls.raise_user_error('invalid_addresses', {
+                    'subject': values['subject'] or '',
+                    'addresses': ', '.join(invalid),
+                    })
+        for name in OPTIONAL_FIELDS:
+            if name not in cls._fields:
+                del values[name]
+        missing = set(n for n, f in cls._fields.items()
+            if f.required and n not in cls._defaults) - set(values)
+        assert not missing, 'Missing electronic mail values: %s' % (
+            ', '.join(sorted(missing)))
+        return values
+
+    @classmethod
+    def outbox_domain(cls):
+        '''Returns the domain of the mails queued by the templates, not sent
+        yet from the outbox of the configuration or of a template
+        '''
+        pool = Pool()
+        Template = pool.get('electronic.mail.template')
+        EmailConfiguration = pool.get('electronic.mail.configuration')
+
+        mailboxes = set(t.mailbox_outbox.id
+            for t in Template.search([
+                    ('queue', '=', True),
+                    ('mailbox_outbox', '!=', None),
+                    ]))
+        outbox = EmailConfiguration(1).outbox
+        if outbox:
+            mailboxes.add(outbox.id)
+        return [
+            ('mailbox', 'in', list(mailboxes)),
+            ('flag_send', '=', False),
+            ('outbox_error', '=', None),
+            ]
+
+    @classmethod
+    def outbox_depth(cls):
+        'Returns the number of mails queued in the outboxes'
+        return cls.search(cls.outbox_domain(), count=True)
+
+    @classmethod
+    def drain_outbox(cls, limit=None):
+        '''Sends the queued mails in batches over the SMTP relay
+
+        Each batch is committed on its own. The sent mails are moved to the
+        sent mailbox. The refused ones keep the error and are moved to the
+        error mailbox, if any, they are not sent again. The mails refused
+        temporarily are kept in the outbox for the next run.
+
+        :param limit: Maximum number of mails to process, all by default
+        :return: Dictionary of the queue depth and drain metrics
+        '''
+        pool = Pool()
+        SMTPServer = pool.get('smtp.server')
+        EmailConfiguration = pool.get('electronic.mail.configuration')
+        transaction = Transaction()
+
+        server = SMTPServer.get_smtp_server_from_model(cls.__name__)
+        if not server:
+            logger.warning('Not configured SMTP server for the outbox')
+            return
+        relay = server.smtp_server
+        batch_size = config.getint('electronic_mail_template',
+            'outbox_batch_size', default=100)
+        # The threads of the drain connect without reading the record
+        connect = smtp_connector(server.smtp_server, server.smtp_port,
+            ssl=server.smtp_ssl, tls=server.smtp_tls,
+            user=server.smtp_user and server.smtp_user.encode('utf-8'),
+            password=(server.smtp_password
+                and server.smtp_password.encode('utf-8')))
+        drain = OutboxDrain(connect,
+            rate=relay_option(relay, 'outbox_rate', 0, float),
+            concurrency=relay_option(relay, 'outbox_concurrency', 1),
+            slow=relay_option(relay, 'outbox_slow', 2., float),
+            max_messages=config.getint('electronic_mail_template',
+                'smtp_session_messages', default=100))
+        configuration = EmailConfiguration(1)
+
+        domain = cls.outbox_domain()
+        depth = cls.search(domain, count=True)
+        metrics = {
+            'relay': relay,
+            'depth': depth,
+            'sent': 0,
+            'deferred': 0,
+            'failed': 0,
+            }
+        start = time.time()
+        last_id = 0
+        processed = 0
+        try:
+            while limit is None or processed < limit:
+                size = batch_size
+                if limit is not None:
+                    size = min(size, limit - processed)
+                mails = cls.search(domain + [('id', '>', last_id)],
+                    order=[('id', 'ASC')], limit=size)
+                if not mails:
+                    break
+                last_id = mails[-1].id
+                processed += len(mails)
+                results = drain.send([m.outbox_message() for m in mails])
+                sent, failed, deferred = [], [], []
+                to_write = []
+                for mail in mails:
+                    result = results.get(mail.id, ('Not sent', True))
+                    if result is None:
+                        sent.append(mail)
+                    elif result[1]:
+                        deferred.append(mail)
+                    else:
+                        logger.warning('Email %s refused: %s', mail.id,
+                            result[0])
+                        failed.append(mail)
+                        values = {
+                            'outbox_error': result[0],
+                            }
+                        if configuration.error:
+                            values['mailbox'] = configuration.error.id
+                        to_write.extend(([mail], values))
+                if sent:
+                    to_write.extend((sent, {
+                                'mailbox': configuration.sent.id,
+                                'flag_send': True,
+                                }))
+                if to_write:
+                    cls.write(*to_write)
+                metrics['sent'] += len(sent)
+                metrics['deferred'] += len(deferred)
+                metrics['failed'] += len(failed)
+                transaction.commit()
+                if len(deferred) == len(mails):
+                    # The relay is not accepting mails, retry on next run
+                    break
+        finally:
+            drain.close()
+        duration = time.time() - start
+        metrics.update(drain.stats())
+        metrics.update({
+                'duration': round(duration, 3),
+                'throughput': (round(metrics['sent'] / duration, 2)
+                    if duration else None),
+                'remaining': cls.search(domain, count=True),
+                })
+        logger.info('Email outbox drained: %s', json.dumps(metrics))
+        return metrics
+
+    def outbox_message(self):
+        '''Returns the (id, from address, recipients, message string) tuple
+        to send the queued mail
+        '''
+        data = bytes(self.mail_file)
+        message = message_from_string(data)
+        addresses = message.get_all('to', []) + message.get_all('cc', [])
+        if self.bcc:
+            addresses.append(self.bcc)
+        recipients = [a for _, a in getaddresses(addresses) if a]
+        from_ = parseaddr(message.get('from', ''))[1]
+        return self.id, from_, recipients, data
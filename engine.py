@@ -0,0 +1,248 @@
+# This file is part electronic_mail_template module for Tryton.
+# The COPYRIGHT file at the top level of this repository contains
+# the full copyright notices and license terms.
+import ast
+import logging
+import marshal
+import re
+from collections import OrderedDict
+from importlib import import_module
+from os import path, makedirs
+
+from trytond.config import config
+
+try:
+    from importlib.util import find_spec
+except ImportError:
+    from pkgutil import find_loader as find_spec
+
+__all__ = ['Engine', 'PythonEngine', 'GenshiEngine', 'Jinja2Engine',
+    'get_engine', 'get_engines']
+
+logger = logging.getLogger(__name__)
+
+# Engines of other packages are registered with "name = module:Class" in the
+# entry points of this group
+ENTRY_POINT_GROUP = 'electronic_mail_template.engines'
+
+_registry = OrderedDict([
+        ('python', __name__ + ':PythonEngine'),
+        ('genshi', __name__ + ':GenshiEngine'),
+        ('jinja2', __name__ + ':Jinja2Engine'),
+        ])
+_entry_points_loaded = False
+_engines = {}
+
+
+def _load_entry_points():
+    global _entry_points_loaded
+    if _entry_points_loaded:
+        return
+    _entry_points_loaded = True
+    try:
+        import pkg_resources
+    except ImportError:
+        return
+    for entry_point in pkg_resources.iter_entry_points(ENTRY_POINT_GROUP):
+        _registry.setdefault(entry_point.name, entry_point)
+
+
+def get_engine(name):
+    '''Returns the engine instance registered as name or None
+
+    The engine class is imported on the first call.
+    '''
+    if name in _engines:
+        return _engines[name]
+    if name not in _registry:
+        _load_entry_points()
+    target = _registry.get(name)
+    engine = None
+    if target is not None:
+        if isinstance(target, str):
+            module_name, class_name = target.split(':')
+            engine_class = getattr(import_module(module_name), class_name)
+        else:
+            engine_class = target.load()
+        engine = engine_class()
+        if not engine.available():
+            logger.error('Unable to use template engine %s. Install %s.',
+                name, ', '.join(engine.requires))
+            engine = None
+    _engines[name] = engine
+    return engine
+
+
+def get_engines():
+    'Returns the name and label of the available engines'
+    _load_entry_points()
+    engines = []
+    for name in _registry:
+        engine = get_engine(name)
+        if engine is not None:
+            engines.append((name, engine.string))
+    return engines
+
+
+class Engine(object):
+    '''Template engine
+
+    The packages of requires are imported by the methods on first use, the
+    engine is available if they are installed. Storable engines implement
+    dump and load.
+    '''
+    string = None
+    requires = ()
+    storable = False
+
+    def available(self):
+        return all(find_spec(r) is not None for r in self.requires)
+
+    def compile(self, expression):
+        'Returns the compiled expression'
+        raise NotImplementedError
+
+    def render(self, compiled, template_context):
+        'Returns the rendered compiled expression'
+        raise NotImplementedError
+
+    def compile_field(self, template, field_name):
+        '''Returns the compiled field of the saved template or None to
+        compile its expression'''
+        return None
+
+    def literal(self, expression):
+        '''Returns the rendered expression if it is a literal, that does not
+        need the engine, or None'''
+        return None
+
+    def compile_program(self, template, field_names):
+        '''Returns a function rendering the fields of the template with a
+        template context in one evaluation, as a list of values, or None to
+        render them one by one'''
+        return None
+
+    def dump(self, expression):
+        '''Returns the compiled expression as bytes to store or None if the
+        engine can not store it'''
+        return None
+
+    def load(self, data):
+        'Returns the compiled expression from the data returned by dump'
+        return None
+
+
+class PythonEngine(Engine):
+    string = 'Python'
+    storable = True
+
+    def compile(self, expression):
+        return compile(expression, '<electronic.mail.template>', 'eval')
+
+    def render(self, code, template_context):
+        assert template_context['record'] is not None, 'Record is undefined'
+        return eval(code, template_context)
+
+    def literal(self, expression):
+        try:
+            value = ast.literal_eval(expression.strip())
+        except (ValueError, SyntaxError):
+            return None
+        if isinstance(value, (type(u''), type(b''))):
+            return value
+
+    def compile_program(self, template, field_names):
+        # Each expression is valid on its own so the parentheses and new
+        # lines keep them apart in the tuple
+        code = self.compile('(%s,)' % ', '.join('(\n%s\n)'
+                % getattr(template, f) for f in field_names))
+        return lambda template_context: list(
+            self.render(code, template_context))
+
+    def dump(self, expression):
+        return marshal.dumps(self.compile(expression))
+
+    def load(self, data):
+        return marshal.loads(data)
+
+
+class GenshiEngine(Engine):
+    string = 'Genshi'
+    requires = ('genshi',)
+
+    def compile(self, expression):
+        from genshi.template import TextTemplate
+        return TextTemplate(expression)
+
+    def render(self, template, template_context):
+        return template.generate(**template_context).render(encoding='UTF-8')
+
+    # The directives of the text template syntax start a line with "#"
+    directive = re.compile(r'^\s*#', re.MULTILINE)
+
+    def literal(self, expression):
+        if (not any(m in expression for m in ('$', '{%', '{#', '\\'))
+                and not self.directive.search(expression)):
+            return expression.encode('utf-8')
+
+
+class Jinja2Engine(Engine):
+    string = 'Jinja2'
+    requires = ('jinja2',)
+
+    def __init__(self):
+        self._environment = None
+
+    @property
+    def environment(self):
+        '''The Jinja2 environment shared by the templates
+
+        Its loader reads the template fields and the compiled templates are
+        stored in the electronic_mail_template/jinja2 directory of the data
+        path, shared by all the processes. The environment does not cache
+        the templates as they are kept in the compiled cache.
+        '''
+        if self._environment is None:
+            from jinja2 import Environment, FileSystemBytecodeCache
+            from .jinja2_loader import TemplateLoader
+
+            directory = path.join(config.get('database', 'path'),
+                'electronic_mail_template', 'jinja2')
+            if not path.isdir(directory):
+                try:
+                    makedirs(directory)
+                except OSError:
+                    if not path.isdir(directory):
+                        raise
+            self._environment = Environment(loader=TemplateLoader(),
+                bytecode_cache=FileSystemBytecodeCache(directory),
+                cache_size=0)
+        return self._environment
+
+    def compile(self, expression):
+        return self.environment.from_string(expression)
+
+    def compile_field(self, template, field_name):
+        return self.environment.get_template(
+            template.jinja2_template_name(field_name))
+
+    def render(self, template, template_context):
+        return template.render(template_context).encode('utf-8')
+
+    def literal(self, expression):
+        if not any(m in expression for m in ('{{', '{%', '{#')):
+            # As the lexer, normalize the new lines and drop the last one
+            return u'\n'.join(expression.splitlines()).encode('utf-8')
+
+    def compile_program(self, template, field_names):
+        # The loader renders a block for each field of a program name
+        if template.id is None or template.id < 0:
+            return None
+        program = self.environment.get_template(
+            template.jinja2_template_name(','.join(field_names)))
+
+        def render(template_context):
+            context = program.new_context(template_context)
+            return [u''.join(program.blocks[f](context)).encode('utf-8')
+                for f in field_names]
+        return render
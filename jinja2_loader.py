@@ -0,0 +1,43 @@
+# This file is part electronic_mail_template module for Tryton.
+# The COPYRIGHT file at the top level of this repository contains
+# the full copyright notices and license terms.
+from __future__ import absolute_import
+
+from jinja2 import BaseLoader, TemplateNotFound
+
+from trytond.pool import Pool
+from trytond.transaction import Transaction
+
+__all__ = ['TemplateLoader']
+
+
+class TemplateLoader(BaseLoader):
+    '''Loads the Jinja2 templates from the fields of the email templates
+
+    The names are built by Template.jinja2_template_name. A name with
+    several fields is a render program with a block for each field.
+    '''
+
+    def get_source(self, environment, name):
+        template_id, field_names, language = name.split('/')[1:4]
+        Template = Pool().get('electronic.mail.template')
+        with Transaction().set_context(language=language or None):
+            template = Template(int(template_id))
+        field_names = field_names.split(',')
+        if len(field_names) == 1:
+            source = getattr(template, field_names[0])
+        else:
+            source = u''.join(u'{%% block %s %%}%s{%% endblock %%}'
+                % (f, self.strip_newline(getattr(template, f) or u''))
+                for f in field_names)
+        if source is None:
+            raise TemplateNotFound(name)
+        return source, None, lambda: True
+
+    @staticmethod
+    def strip_newline(source):
+        'Drops the last new line as the lexer does at the end of a template'
+        for newline in (u'\r\n', u'\r', u'\n'):
+            if source.endswith(newline):
+                return source[:-len(newline)]
+        return source
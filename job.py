@@ -0,0 +1,176 @@
+# This file is part electronic_mail_template module for Tryton.
+# The COPYRIGHT file at the top level of this repository contains
+# the full copyright notices and license terms.
+import datetime
+import logging
+import traceback
+from collections import OrderedDict
+
+from trytond.config import config
+from trytond.model import ModelView, ModelSQL, fields
+from trytond.pyson import Eval
+from trytond.transaction import Transaction
+from trytond.pool import Pool
+
+__all__ = ['TemplateJob']
+
+logger = logging.getLogger(__name__)
+
+
+class TemplateJob(ModelSQL, ModelView):
+    'Email Template Job'
+    __name__ = 'electronic.mail.template.job'
+
+    template = fields.Many2One('electronic.mail.template', 'Template',
+        required=True, ondelete='CASCADE', select=True, readonly=True)
+    model = fields.Char('Model', required=True, readonly=True)
+    record_id = fields.Integer('Record ID', required=True, readonly=True)
+    state = fields.Selection([
+            ('pending', 'Pending'),
+            ('done', 'Done'),
+            ('failed', 'Failed'),
+            ], 'State', required=True, select=True, readonly=True)
+    attempts = fields.Integer('Attempts', readonly=True)
+    next_try = fields.DateTime('Next Try', select=True, readonly=True)
+    error = fields.Text('Error', readonly=True,
+        states={
+            'invisible': ~Eval('error'),
+            })
+
+    @classmethod
+    def __setup__(cls):
+        super(TemplateJob, cls).__setup__()
+        cls._order.insert(0, ('id', 'DESC'))
+        cls._buttons.update({
+                'retry': {
+                    'invisible': Eval('state') != 'failed',
+                    },
+                })
+
+    @staticmethod
+    def default_state():
+        return 'pending'
+
+    @staticmethod
+    def default_attempts():
+        return 0
+
+    @classmethod
+    def create_from_records(cls, template, records):
+        '''Records a job for each record to render and send later
+        :param template: Template instance
+        :param records: List of browse records
+        '''
+        return cls.create([{
+                    'template': template.id,
+                    'model': r.__name__,
+                    'record_id': r.id,
+                    } for r in records])
+
+    @classmethod
+    def create_failed(cls, template, errors):
+        '''Records a failed job for each record, to retry manually
+        :param template: Template instance
+        :param errors: List of (browse record, error) tuples
+        '''
+        return cls.create([{
+                    'template': template.id,
+                    'model': r.__name__,
+                    'record_id': r.id,
+                    'state': 'failed',
+                    'error': error,
+                    } for r, error in errors])
+
+    @classmethod
+    @ModelView.button
+    def retry(cls, jobs):
+        cls.write(jobs, {
+                'state': 'pending',
+                'attempts': 0,
+                'next_try': None,
+                'error': None,
+                })
+
+    @classmethod
+    def process(cls, limit=None):
+        '''Renders and sends the pending jobs in bulk, one batch per template
+
+        Each batch is committed on its own. The records that fail are
+        isolated by Template.render_and_send_each and their jobs retried
+        later with an exponential backoff until they reach the maximum
+        attempts, then they are kept as failed. The records already sent are
+        not sent again. Nothing is committed if the context has
+        _email_template_commit set to False.
+        '''
+        pool = Pool()
+        transaction = Transaction()
+
+        if limit is None:
+            limit = config.getint('electronic_mail_template',
+                'job_batch_size', default=500)
+        now = datetime.datetime.now()
+        jobs = cls.search([
+                ('state', '=', 'pending'),
+                ['OR',
+                    ('next_try', '=', None),
+                    ('next_try', '<=', now),
+                    ],
+                ], order=[('id', 'ASC')], limit=limit)
+
+        batches = OrderedDict()
+        for job in jobs:
+            batches.setdefault((job.template.id, job.model), []).append(job.id)
+
+        Template = pool.get('electronic.mail.template')
+        for (template_id, model), job_ids in batches.items():
+            Model = pool.get(model)
+            jobs = cls.browse(job_ids)
+            try:
+                with transaction.set_context(active_test=False):
+                    records = Model.search([
+                            ('id', 'in', [j.record_id for j in jobs]),
+                            ])
+                _, errors = Template(template_id).render_and_send_each(
+                    records)
+            except Exception:
+                transaction.rollback()
+                logger.error('Email template jobs %s failed', job_ids,
+                    exc_info=True)
+                cls.postpone(cls.browse(job_ids), traceback.format_exc())
+            else:
+                done = [j for j in jobs if j.record_id not in errors]
+                if done:
+                    cls.write(done, {
+                            'state': 'done',
+                            'error': None,
+                            })
+                for job in jobs:
+                    if job.record_id in errors:
+                        cls.postpone([job], errors[job.record_id])
+            if transaction.context.get('_email_template_commit', True):
+                transaction.commit()
+
+    @classmethod
+    def postpone(cls, jobs, error):
+        '''Schedules the jobs for a new attempt or marks them as failed
+        '''
+        max_attempts = config.getint('electronic_mail_template',
+            'job_max_attempts', default=5)
+        delay = config.getint('electronic_mail_template', 'job_retry_delay',
+            default=60)
+        now = datetime.datetime.now()
+        to_write = []
+        for job in jobs:
+            attempts = (job.attempts or 0) + 1
+            values = {
+                'attempts': attempts,
+                'error': error,
+                }
+            if attempts >= max_attempts:
+                values['state'] = 'failed'
+            else:
+                values['next_try'] = now + datetime.timedelta(
+                    seconds=delay * 2 ** (attempts - 1))
+            to_write.extend(([job], values))
+        if to_write:
+            cls.write(*to_write)
@@ -0,0 +1,190 @@
+# This file is part electronic_mail_template module for Tryton.
+# The COPYRIGHT file at the top level of this repository contains
+# the full copyright notices and license terms.
+import logging
+import smtplib
+import socket
+import threading
+import time
+
+from trytond.config import config
+
+from .session import SMTPSession
+
+try:
+    from queue import Queue, Empty
+except ImportError:
+    from Queue import Queue, Empty
+
+__all__ = ['RateLimiter', 'OutboxDrain', 'relay_option', 'smtp_connector']
+
+logger = logging.getLogger(__name__)
+
+
+def relay_option(relay, name, default, type_=int):
+    '''Returns the option of the relay section, "electronic_mail_template
+    <relay>", or else of the electronic_mail_template section
+    '''
+    value = config.get('electronic_mail_template %s' % relay, name)
+    if value is None:
+        value = config.get('electronic_mail_template', name)
+    if value is None:
+        return default
+    return type_(value)
+
+
+def smtp_connector(host, port, ssl=False, tls=False, user=None,
+        password=None):
+    '''Returns a callable connecting to the SMTP server as the smtp.server
+    does, that can be called from any thread as it does not read the record
+    '''
+    def connect():
+        if ssl:
+            server = smtplib.SMTP_SSL(host, port)
+        else:
+            server = smtplib.SMTP(host, port)
+        if tls:
+            server.starttls()
+        if user and password:
+            server.login(user, password)
+        return server
+    return connect
+
+
+class RateLimiter(object):
+    '''Spaces the messages sent to a relay
+
+    The interval between two messages is 1 / rate, unlimited if rate is 0,
+    plus a backpressure delay. The delay is doubled each time the relay is
+    slow or refuses a message temporarily, up to max_delay, and halved each
+    time it answers in time.
+    '''
+    min_delay = 0.05
+
+    def __init__(self, rate=0, max_delay=30., clock=time.time,
+            sleep=time.sleep):
+        self.interval = 1. / rate if rate else 0.
+        self.max_delay = max_delay
+        self.delay = 0.
+        self.clock = clock
+        self.sleep = sleep
+        self._next = 0.
+        self._lock = threading.Lock()
+
+    def wait(self):
+        'Blocks until the next message can be sent'
+        with self._lock:
+            now = self.clock()
+            start = max(now, self._next)
+            self._next = start + self.interval + self.delay
+        if start > now:
+            self.sleep(start - now)
+
+    def slow_down(self):
+        with self._lock:
+            self.delay = min(self.max_delay,
+                max(self.min_delay, self.delay * 2))
+
+    def speed_up(self):
+        with self._lock:
+            self.delay /= 2
+            if self.delay < self.min_delay:
+                self.delay = 0.
+
+
+class OutboxDrain(object):
+    '''Sends messages to a relay over a pool of SMTP sessions
+
+    Each of the concurrency threads sends over its own session, kept open
+    between the calls to send until close. The rate limiter spaces the
+    messages of all the threads and slows them down when a message takes
+    more than slow seconds or is refused temporarily.
+    '''
+
+    def __init__(self, connect, rate=0, concurrency=1, slow=2.,
+            max_delay=30., max_messages=100):
+        '''
+        :param connect: Callable returning a connected smtplib.SMTP, called
+            by the threads so it must not use the transaction
+        :param rate: Messages per second (0 for no limit)
+        :param concurrency: Number of connections
+        :param slow: Seconds above which a message slows the rate down
+        :param max_messages: Messages sent over a connection before it is
+            renewed
+        '''
+        self.limiter = RateLimiter(rate, max_delay=max_delay)
+        self.slow = slow
+        self.sessions = [SMTPSession(connect, max_messages=max_messages)
+            for _ in range(max(concurrency, 1))]
+
+    def send(self, messages):
+        '''Sends the messages
+
+        :param messages: List of (key, from address, recipients, message
+            string) tuples
+        :return: Dictionary of key and None if sent, or a tuple of the error
+            and True if it is temporary
+        '''
+        results = {}
+        if not messages:
+            return results
+        queue = Queue()
+        for message in messages:
+            queue.put(message)
+        try:
+            for session in self.sessions:
+                if not session.connected:
+                    session.open()
+        except (smtplib.SMTPException, socket.error) as e:
+            logger.warning('SMTP relay unavailable: %s', e)
+            self.limiter.slow_down()
+            return dict((m[0], (str(e), True)) for m in messages)
+
+        threads = [threading.Thread(target=self._send_queue,
+                args=(session, queue, results))
+            for session in self.sessions]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def _send_queue(self, session, queue, results):
+        while True:
+            try:
+                key, from_, recipients, data = queue.get_nowait()
+            except Empty:
+                return
+            self.limiter.wait()
+            start = time.time()
+            try:
+                session.sendmail(from_, recipients, data)
+            except smtplib.SMTPRecipientsRefused as e:
+                results[key] = (str(e), False)
+            except smtplib.SMTPResponseException as e:
+                temporary = 400 <= e.smtp_code < 500
+                results[key] = (str(e), temporary)
+                if temporary:
+                    self.limiter.slow_down()
+            except (smtplib.SMTPException, socket.error) as e:
+                results[key] = (str(e), True)
+                self.limiter.slow_down()
+                # Reconnect for the next message
+                session.close()
+            else:
+                results[key] = None
+                if time.time() - start > self.slow:
+                    self.limiter.slow_down()
+                else:
+                    self.limiter.speed_up()
+
+    def stats(self):
+        return {
+            'connections': sum(s.connections for s in self.sessions),
+            'messages': sum(s.messages for s in self.sessions),
+            'delay': self.limiter.delay,
+            }
+
+    def close(self):
+        for session in self.sessions:
+            session.close()
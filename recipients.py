@@ -0,0 +1,92 @@
+# This file is part electronic_mail_template module for Tryton.
+# The COPYRIGHT file at the top level of this repository contains
+# the full copyright notices and license terms.
+import re
+from email.utils import formataddr, getaddresses
+
+__all__ = ['normalize_address', 'normalize_recipients']
+
+# ASCII addresses, the SMTP sessions do not use SMTPUTF8 so international
+# domains, and their top level domain, are IDNA encoded before
+ADDRESS = re.compile(r"^[A-Za-z0-9_!#$%&'*+/=?^`{|}~-]+"
+    r"(?:\.[A-Za-z0-9_!#$%&'*+/=?^`{|}~-]+)*"
+    r"@(?:[A-Za-z0-9](?:[A-Za-z0-9-]{0,61}[A-Za-z0-9])?\.)+"
+    r"(?:[A-Za-z]{2,63}|xn--[A-Za-z0-9-]{1,59})$")
+# The empty items of an address list, between commas or at its ends
+EMPTY_ITEM = re.compile(r'(?:^|,)\s*(?=,|$)')
+# The semicolons separating addresses, those out of quoted names
+SEMICOLON = re.compile(r';(?=(?:[^"]*"[^"]*")*[^"]*$)')
+CACHE_SIZE = 10000
+
+_cache = {}
+
+
+def normalize_address(address):
+    '''Returns the address with its domain IDNA encoded and in lower case,
+    or None if it is not valid
+
+    The results are cached by address, the cache is emptied when it reaches
+    CACHE_SIZE entries.
+    '''
+    try:
+        return _cache[address]
+    except KeyError:
+        pass
+    result = None
+    local, _, domain = address.rpartition(u'@')
+    try:
+        domain = domain.encode('idna').decode('ascii')
+    except UnicodeError:
+        domain = None
+    if local and domain:
+        normalized = u'%s@%s' % (local, domain.lower())
+        if ADDRESS.match(normalized):
+            result = normalized
+    if len(_cache) >= CACHE_SIZE:
+        _cache.clear()
+    _cache[address] = result
+    return result
+
+
+def normalize_recipients(to=None, cc=None, bcc=None):
+    '''Parses and normalizes the address lists of To, Cc and Bcc
+
+    The addresses can be separated by commas or semicolons. An address is
+    kept only in the first list where it appears, and only once, regardless
+    of its case.
+
+    :return: tuple of the To, Cc and Bcc address lists, or None if empty, of
+        the same type as given, and the list of the invalid addresses
+    '''
+    seen = set()
+    invalid = []
+    result = []
+    for value in (to, cc, bcc):
+        encode = isinstance(value, bytes)
+        if encode:
+            value = value.decode('utf-8')
+        if value:
+            value = SEMICOLON.sub(u',', value)
+            value = EMPTY_ITEM.sub(u'', value).strip(u' ,')
+        addresses = []
+        for name, address in getaddresses([value] if value else []):
+            normalized = None
+            if address:
+                normalized = normalize_address(address)
+            else:
+                # Not parsable
+                address = name or value
+            if normalized is None:
+                if address not in invalid:
+                    invalid.append(address)
+                continue
+            key = normalized.lower()
+            if key in seen:
+                continue
+            seen.add(key)
+            addresses.append(formataddr((name, normalized)))
+        value = u', '.join(addresses) or None
+        if value is not None and encode:
+            value = value.encode('utf-8')
+        result.append(value)
+    return tuple(result) + (invalid,)
@@ -0,0 +1,80 @@
+# This file is part electronic_mail_template module for Tryton.
+# The COPYRIGHT file at the top level of this repository contains
+# the full copyright notices and license terms.
+import logging
+import smtplib
+import socket
+
+__all__ = ['SMTPSession']
+
+logger = logging.getLogger(__name__)
+
+
+class SMTPSession(object):
+    '''SMTP connection shared by the messages of a batch
+
+    The connection is opened with the first message, reopened when the server
+    drops it and renewed every max_messages messages.
+    '''
+
+    def __init__(self, connect, max_messages=100):
+        '''
+        :param connect: Callable returning a connected smtplib.SMTP
+        :param max_messages: Messages sent over a connection before it is
+            renewed (0 for no limit)
+        '''
+        self.connect = connect
+        self.max_messages = max_messages
+        self.connections = 0
+        self.messages = 0
+        self._server = None
+        self._server_messages = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    @property
+    def connected(self):
+        return self._server is not None
+
+    def open(self):
+        self.close()
+        self._server = self.connect()
+        self._server_messages = 0
+        self.connections += 1
+
+    def close(self):
+        if self._server is None:
+            return
+        try:
+            self._server.quit()
+        except (smtplib.SMTPException, socket.error):
+            self._server.close()
+        self._server = None
+
+    def sendmail(self, from_addr, to_addrs, msg):
+        '''Sends the message string and returns the refused recipients
+        '''
+        if (self._server is None
+                or (self.max_messages
+                    and self._server_messages >= self.max_messages)):
+            self.open()
+        try:
+            result = self._server.sendmail(from_addr, to_addrs, msg)
+        except (smtplib.SMTPServerDisconnected, socket.error):
+            logger.info('SMTP connection lost, reconnecting')
+            self._server = None
+            self.open()
+            result = self._server.sendmail(from_addr, to_addrs, msg)
+        self._server_messages += 1
+        self.messages += 1
+        return result
+
+    def stats(self):
+        return {
+            'connections': self.connections,
+            'messages': self.messages,
+            }
@@ -111,6 +111,10 @@ setup(name=name,
     entry_points="""
     [trytond.modules]
     electronic_mail_template = trytond.modules.electronic_mail_template
+    [electronic_mail_template.engines]
+    python = trytond.modules.electronic_mail_template.engine:PythonEngine
+    genshi = trytond.modules.electronic_mail_template.engine:GenshiEngine
+    jinja2 = trytond.modules.electronic_mail_template.engine:Jinja2Engine
     """,
     test_suite='tests',
     test_loader='trytond.test_loader:Loader',
@@ -0,0 +1,203 @@
+# This file is part electronic_mail_template module for Tryton.
+# The COPYRIGHT file at the top level of this repository contains
+# the full copyright notices and license terms.
+import datetime
+import json
+import logging
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from trytond.config import config
+from trytond.model import ModelView, ModelSQL, fields
+
+__all__ = ['TemplateStats']
+
+logger = logging.getLogger(__name__)
+
+_local = threading.local()
+
+
+class BatchStats(object):
+    '''Number of calls, duration and bytes of each stage of a batch
+    '''
+
+    def __init__(self, template):
+        self.template = template
+        self.records = 0
+        self.start = time.time()
+        self.duration = None
+        self.stages = OrderedDict()
+
+    def add(self, name, duration, size=0):
+        stage = self.stages.get(name)
+        if stage is None:
+            stage = self.stages[name] = [0, 0., 0]
+        stage[0] += 1
+        stage[1] += duration
+        stage[2] += size
+
+    def stop(self):
+        self.duration = time.time() - self.start
+
+    def as_dict(self):
+        return {
+            'template': self.template.id,
+            'records': self.records,
+            'duration': round(self.duration or 0, 6),
+            'stages': OrderedDict((name, {
+                            'calls': calls,
+                            'duration': round(duration, 6),
+                            'bytes': size,
+                            })
+                for name, (calls, duration, size) in self.stages.items()),
+            }
+
+
+class Stage(object):
+    'Times a stage of the current batch'
+    __slots__ = ('batch', 'name', 'size', 'start')
+
+    def __init__(self, batch, name):
+        self.batch = batch
+        self.name = name
+        self.size = 0
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.batch.add(self.name, time.time() - self.start, self.size)
+
+
+class NullStage(object):
+    'Stage used when the batch is not instrumented'
+    size = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        pass
+
+    def __setattr__(self, name, value):
+        pass
+
+
+_null_stage = NullStage()
+
+
+def enabled():
+    return config.getboolean('electronic_mail_template', 'stats',
+        default=False)
+
+
+class Instrument(object):
+    '''Instruments the stages run inside it for the template if the stats
+    are enabled or forced, the BatchStats is returned by the with statement
+    or None
+    '''
+
+    def __init__(self, template, force=False):
+        self.stats = (BatchStats(template) if force or enabled()
+            else None)
+
+    def __enter__(self):
+        self.previous = getattr(_local, 'batch', None)
+        _local.batch = self.stats
+        return self.stats
+
+    def __exit__(self, type, value, traceback):
+        _local.batch = self.previous
+        if self.stats is not None:
+            self.stats.stop()
+
+
+def instrument(template, force=False):
+    return Instrument(template, force=force)
+
+
+def stage(name):
+    '''Returns the context manager timing the stage name of the current
+    batch, its size attribute can be set to the number of bytes processed
+    '''
+    current = getattr(_local, 'batch', None)
+    if current is None:
+        return _null_stage
+    return Stage(current, name)
+
+
+class TemplateStats(ModelSQL, ModelView):
+    'Email Template Stats'
+    __name__ = 'electronic.mail.template.stats'
+
+    template = fields.Many2One('electronic.mail.template', 'Template',
+        required=True, ondelete='CASCADE', select=True, readonly=True)
+    batch = fields.Char('Batch', required=True, select=True, readonly=True)
+    date = fields.DateTime('Date', required=True, readonly=True)
+    records = fields.Integer('Records', readonly=True)
+    stage = fields.Char('Stage', required=True, select=True, readonly=True)
+    calls = fields.Integer('Calls', readonly=True)
+    duration = fields.Float('Duration', digits=(16, 6), readonly=True,
+        help='In seconds')
+    bytes = fields.Integer('Bytes', readonly=True)
+
+    @classmethod
+    def __setup__(cls):
+        super(TemplateStats, cls).__setup__()
+        cls._order.insert(0, ('date', 'DESC'))
+
+    @classmethod
+    def record(cls, stats):
+        '''Stores the BatchStats and logs them as a JSON line
+        '''
+        values = stats.as_dict()
+        logger.info('Email template batch: %s', json.dumps(values))
+        batch = uuid.uuid4().hex
+        date = datetime.datetime.fromtimestamp(stats.start)
+        to_create = [{
+                'template': stats.template.id,
+                'batch': batch,
+                'date': date,
+                'records': stats.records,
+                'stage': 'batch',
+                'calls': 1,
+                'duration': stats.duration,
+                'bytes': 0,
+                }]
+        for name, (calls, duration, size) in stats.stages.items():
+            to_create.append({
+                    'template': stats.template.id,
+                    'batch': batch,
+                    'date': date,
+                    'records': stats.records,
+                    'stage': name,
+                    'calls': calls,
+                    'duration': duration,
+                    'bytes': size,
+                    })
+        return cls.create(to_create)
+
+    @classmethod
+    def summary(cls, template=None, since=None):
+        '''Returns the calls, duration and bytes of each stage, summed over
+        the stored batches of the template since the date
+        '''
+        domain = []
+        if template is not None:
+            domain.append(('template', '=', template.id))
+        if since is not None:
+            domain.append(('date', '>=', since))
+        result = OrderedDict()
+        for stats in cls.search(domain, order=[('stage', 'ASC')]):
+            values = result.setdefault(stats.stage, {
+                    'calls': 0,
+                    'duration': 0.,
+                    'bytes': 0,
+                    })
+            values['calls'] += stats.calls or 0
+            values['duration'] += stats.duration or 0
+            values['bytes'] += stats.bytes or 0
+        return result
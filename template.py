@@ -7,32 +7,120 @@ from os import path, listdir
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 from email.mime.base import MIMEBase
-from email.utils import formatdate
-from email import Encoders, charset
-from genshi.template import TextTemplate
+from email.utils import formatdate, getaddresses, parseaddr
+from email import Encoders, charset, message_from_string
+from collections import OrderedDict
 from trytond import backend
-from trytond.model import ModelView, ModelSQL, fields
+from trytond.cache import Cache
+from trytond.config import config
+from trytond.model import ModelView, ModelSQL, ModelStorage, fields
 from trytond.transaction import Transaction
 from trytond.pyson import Eval
 from trytond.pool import Pool
+from .cache import CountedCache, FileCache
+from .session import SMTPSession
+from .engine import get_engine
+from .recipients import normalize_recipients
+from .stats import instrument, stage
+from .trigger import TriggerDataManager
+from . import engine as template_engine
+import base64
+import hashlib
 import mimetypes
 import logging
+import multiprocessing
+import re
+import sys
+import tempfile
+import traceback
 
 logger = logging.getLogger(__name__)
 
-try:
-    from jinja2 import Template as Jinja2Template
-    jinja2_loaded = True
-except ImportError:
-    jinja2_loaded = False
-    logger.error('Unable to import jinja2. Install jinja2 package.')
+__all__ = ['Template', 'TemplateCompiled', 'TemplateReport']
 
-__all__ = ['Template', 'TemplateReport']
+# A multiple of 57 bytes, encoded in complete 76 characters base64 lines
+BASE64_CHUNK_SIZE = 57 * 1024
+SPOOL_MAX_SIZE = 1024 * 1024
+HTML_TEMPLATE = """
+                <html>
+                <head><head>
+                <style>
+                %s
+                </style>
+                <body>
+                %s
+                </body>
+                </html>
+                """
+RECORD_PATH = re.compile(r'\brecord((?:\.[A-Za-z_]\w*(?:\[\d+\])?)+)')
+EXPRESSION_FIELDS = ('from_', 'sender', 'to', 'cc', 'bcc', 'reply_to',
+    'subject', 'language', 'plain', 'html', 'message_id', 'in_reply_to',
+    'activity')
+# Fields rendered by the render program, the headers can be literals
+PROGRAM_FIELDS = ('from_', 'sender', 'to', 'cc', 'subject', 'message_id',
+    'in_reply_to', 'reply_to', 'plain', 'html')
+BODY_FIELDS = ('plain', 'html')
+# Marshalled code objects are only valid for the interpreter that dumps them
+PYTHON_TAG = '%s-%s.%s' % ((sys.implementation.name
+        if hasattr(sys, 'implementation') else 'cpython'),
+    sys.version_info[0], sys.version_info[1])
 
 def styles_dir():
     return '%s/styles/' % (path.dirname(path.realpath(__file__)))
 
 
+_styles = {}
+
+
+def load_styles():
+    'Loads the CSS of the styles directory into the style registry'
+    styles = {}
+    for name in listdir(styles_dir()):
+        with open(path.join(styles_dir(), name)) as f:
+            styles[name] = f.read()
+    _styles.clear()
+    _styles.update(styles)
+
+
+_report_caches = {}
+
+
+def report_cache():
+    'Returns the report output cache of the database or None if disabled'
+    size = config.getint('electronic_mail_template', 'report_cache_size',
+        default=0)
+    if not size:
+        return
+    database_name = Transaction().database.name
+    if database_name not in _report_caches:
+        directory = path.join(config.get('database', 'path'),
+            database_name, 'electronic_mail_template', 'reports')
+        _report_caches[database_name] = FileCache(directory,
+            size * 1024 * 1024)
+    return _report_caches[database_name]
+
+
+def _init_render_worker():
+    'Do not share the database connections of the parent process'
+    Database = backend.get('Database')
+    databases = getattr(Database, '_databases', None)
+    if databases:
+        databases.clear()
+
+
+def _render_worker(args):
+    '''Render a chunk of records in its own transaction
+
+    A forked worker inherits the transactions of the thread that created it,
+    so a new one is always started.
+    '''
+    database_name, user, context, template_id, ids = args
+    with Transaction(new=True).start(database_name, user, readonly=True,
+            context=context):
+        Template = Pool().get('electronic.mail.template')
+        return Template(template_id).render_chunk(ids)
+
+
 class Template(ModelSQL, ModelView):
     'Email Template'
     __name__ = 'electronic.mail.template'
@@ -76,12 +164,41 @@ class Template(ModelSQL, ModelView):
     activity = fields.Char('Activity',
         help='Generate a new activity record related a party:\n' \
             '${record.party.id}')
+    prefetch = fields.Text('Prefetch',
+        help='Dotted paths of the record loaded for the whole batch before '
+            'rendering, one per line. eg. party.addresses.city\n'
+            'Paths used in the expressions are added automatically.')
+    parallel = fields.Boolean('Parallel Rendering',
+        help='Render large batches in worker processes. The number of '
+            'processes is set in the trytond configuration.')
+    deferred = fields.Boolean('Deferred',
+        help='Mails from triggers are recorded as jobs and sent later in '
+            'bulk by a scheduled task instead of inside the transaction '
+            'that fires the trigger.')
+    digest = fields.Boolean('Digest',
+        help='Send one mail for each group of records of a batch with the '
+            'same To and CC, with the list of records in "records" and the '
+            'reports of all of them attached.')
+    _compiled_cache = CountedCache('electronic_mail_template.compiled',
+        size_limit=config.getint('electronic_mail_template', 'compiled_cache',
+            default=1024),
+        context=False)
+    _html_wrapper_cache = Cache('electronic_mail_template.html_wrapper',
+        context=False)
+    _activity_reference_cache = Cache(
+        'electronic_mail_template.activity_reference', context=False)
 
     @classmethod
     def __setup__(cls):
         super(Template, cls).__setup__()
+        load_styles()
         cls._error_messages.update({
                 'recipients_error': 'Not valid recipients emails. Check emails in To, Cc or Bcc',
+                'invalid_recipients': ('Invalid addresses of "%(record)s": '
+                    '%(addresses)s'),
+                'invalid_expression': ('Invalid expression in field '
+                    '"%(field)s" of template "%(template)s" '
+                    '(language: %(language)s):\n%(error)s'),
                 })
 
     @classmethod
@@ -106,6 +223,119 @@ class Template(ModelSQL, ModelView):
     def check_xml_record(cls, records, values):
         return True
 
+    @classmethod
+    def create(cls, vlist):
+        templates = super(Template, cls).create(vlist)
+        cls.compile_templates(templates)
+        return templates
+
+    @classmethod
+    def write(cls, *args):
+        super(Template, cls).write(*args)
+        cls.compile_templates(sum(args[0:None:2], []))
+
+    @classmethod
+    def compile_templates(cls, templates):
+        '''Compiles the expressions of the templates in each translatable
+        language and stores the compiled code of the engines that support it
+
+        Raises an error on the first invalid expression.
+        '''
+        pool = Pool()
+        Lang = pool.get('ir.lang')
+        Compiled = pool.get('electronic.mail.template.compiled')
+
+        ids = [t.id for t in templates]
+        Compiled.delete(Compiled.search([
+                    ('template', 'in', ids),
+                    ]))
+        default_language = Transaction().language
+        languages = [default_language] + [l.code for l in Lang.search([
+                    ('translatable', '=', True),
+                    ('code', '!=', default_language),
+                    ])]
+        to_create = []
+        for language in languages:
+            with Transaction().set_context(language=language):
+                for template in cls.browse(ids):
+                    to_create.extend(
+                        template.compile_expressions(language,
+                            translated_only=language != default_language))
+        if to_create:
+            Compiled.create(to_create)
+
+    def compile_expressions(self, language, translated_only=False):
+        '''Compiles the expression fields of the template
+
+        :param language: Code of the language of the translated fields
+        :param translated_only: Only compile the translated fields
+        :return: List of values of the compiled expressions to store
+        '''
+        engine = get_engine(self.engine)
+        if engine is None:
+            return []
+        values = []
+        for field_name in EXPRESSION_FIELDS:
+            translate = self._fields[field_name].translate
+            if translated_only and not translate:
+                continue
+            expression = getattr(self, field_name)
+            if not expression:
+                continue
+            try:
+                compiled, code = engine.compile_field(self, field_name), None
+                if compiled is None:
+                    compiled = engine.compile(expression)
+                    code = engine.dump(expression)
+            except Exception as e:
+                self.raise_user_error('invalid_expression', {
+                        'field': self._fields[field_name].string,
+                        'template': self.rec_name,
+                        'language': language,
+                        'error': e,
+                        })
+            if compiled is None or code is None:
+                continue
+            values.append({
+                    'template': self.id,
+                    'field': field_name,
+                    'language': language if translate else None,
+                    'engine': self.engine,
+                    'python': PYTHON_TAG,
+                    'digest': hashlib.sha1(
+                        expression.encode('utf-8')).hexdigest(),
+                    'code': code,
+                    })
+        return values
+
+    def load_compiled(self, expression, field_name):
+        '''Returns the stored compiled :attr:expression of the field or None
+        if it is missing or outdated
+        '''
+        engine = get_engine(self.engine)
+        if engine is None or not engine.storable:
+            return
+        Compiled = Pool().get('electronic.mail.template.compiled')
+        language = None
+        if self._fields[field_name].translate:
+            language = (self._context.get('language')
+                or Transaction().language)
+        stored = Compiled.search([
+                ('template', '=', self.id),
+                ('field', '=', field_name),
+                ('language', '=', language),
+                ('engine', '=', self.engine),
+                ('python', '=', PYTHON_TAG),
+                ], limit=1)
+        if (not stored or stored[0].digest != hashlib.sha1(
+                    expression.encode('utf-8')).hexdigest()):
+            return
+        try:
+            return engine.load(bytes(stored[0].code))
+        except Exception:
+            logger.warning('Unable to load the compiled expression %s of '
+                'template %s', field_name, self.id, exc_info=True)
+
     @staticmethod
     def default_engine():
         '''Default Engine'''
@@ -117,29 +347,105 @@ class Template(ModelSQL, ModelView):
 
         :return: List of tuples
         '''
-        engines = [
-            ('python', 'Python'),
-            ('genshi', 'Genshi'),
-            ]
-        if jinja2_loaded:
-            engines.append(('jinja2', 'Jinja2'))
-        return engines
+        return template_engine.get_engines()
 
     @classmethod
     def get_style(cls):
         styles = [(None, '')]
-        for s in listdir(styles_dir()):
+        for s in sorted(_styles):
             styles.append((s, s[:-4].capitalize()))
         return styles
 
-    def eval(self, expression, record):
+    @classmethod
+    def reload_styles(cls):
+        '''Reloads the styles directory into the style registry
+        '''
+        load_styles()
+        cls._html_wrapper_cache.clear()
+
+    def get_html_wrapper(self):
+        '''Returns the HTML prefix and suffix wrapping the body with the
+        style of the template, cached until the template is modified
+        '''
+        key = None
+        if self.id is not None and self.id >= 0:
+            key = (self.id, self.write_date or self.create_date)
+            wrapper = self._html_wrapper_cache.get(key)
+            if wrapper is not None:
+                return wrapper
+
+        style = ''
+        if self.style:
+            style = _styles.get(self.style, '')
+            if self.custom_style:
+                style += '\n%s' % self.custom_style
+        elif self.custom_style:
+            style = '%s' % self.custom_style
+
+        head, body, tail = HTML_TEMPLATE.split('%s')
+        wrapper = (head + style + body, tail)
+        if key is not None:
+            self._html_wrapper_cache.set(key, wrapper)
+        return wrapper
+
+    def eval(self, expression, record, field_name=None,
+            template_context=None):
         '''Evaluates the given :attr:expression
 
         :param expression: Expression to evaluate
         :param record: The browse record of the record
+        :param field_name: Name of the template field the expression comes
+            from, used to key the compiled template cache
+        :param template_context: Base template context to reuse instead of
+            building a new one
         '''
-        engine_method = getattr(self, '_engine_' + self.engine)
-        return engine_method(expression, record)
+        engine = get_engine(self.engine)
+        if engine is None:
+            # The package of the engine is not installed
+            return u''
+        compiled = self.get_compiled(expression, field_name)
+        if compiled is None:
+            return u''
+        if template_context is None:
+            template_context = self.template_context(record)
+        else:
+            template_context = dict(template_context, record=record)
+        return engine.render(compiled, template_context)
+
+    def get_compiled(self, expression, field_name=None):
+        '''Returns the compiled :attr:expression for the template engine
+
+        Expressions of template fields are cached by template, field,
+        language and write date so editing the template invalidates them.
+        On a cache miss, the code compiled when the template was saved is
+        loaded if available, unless the engine compiles the fields of saved
+        templates itself. Other expressions are cached by engine and text.
+        '''
+        engine = get_engine(self.engine)
+        if not expression or engine is None:
+            return None
+        saved = field_name and self.id is not None and self.id >= 0
+        if saved:
+            key = (self.id, field_name, self._context.get('language'),
+                self.write_date or self.create_date)
+        else:
+            key = (self.engine, expression)
+        compiled = self._compiled_cache.get(key)
+        if compiled is None:
+            if saved and field_name in EXPRESSION_FIELDS:
+                compiled = engine.compile_field(self, field_name)
+                if compiled is None:
+                    compiled = self.load_compiled(expression, field_name)
+            if compiled is None:
+                compiled = engine.compile(expression)
+            self._compiled_cache.set(key, compiled)
+        return compiled
+
+    @classmethod
+    def compiled_cache_stats(cls):
+        '''Returns the hit and miss counters of the compiled template cache
+        '''
+        return cls._compiled_cache.stats()
 
     @staticmethod
     def template_context(record):
@@ -156,42 +462,133 @@ class Template(ModelSQL, ModelView):
             'user': user,
             }
 
-    @classmethod
-    def _engine_python(cls, expression, record):
-        '''Evaluate the pythonic expression and return its value
-        '''
-        if expression is None:
-            return u''
-
-        assert record is not None, 'Record is undefined'
-        template_context = cls.template_context(record)
-        return eval(expression, template_context)
+    def jinja2_template_name(self, field_name):
+        '''Returns the name of the field, or of the comma separated fields of
+        a render program, in the Jinja2 environment
 
-    @classmethod
-    def _engine_genshi(cls, expression, record):
+        The name does not change with the template, so its bytecode cache
+        entry is replaced when the source checksum differs.
         '''
-        :param expression: Expression to evaluate
-        :param record: Browse record
+        language = ''
+        if any(self._fields[f].translate for f in field_name.split(',')):
+            language = (self._context.get('language')
+                or Transaction().language)
+        return '/'.join([Transaction().database.name, str(self.id),
+                field_name, language])
+
+    def get_program(self):
+        '''Returns the render program of the template, cached as the
+        compiled expressions
         '''
-        if not expression:
-            return u''
-
-        template = TextTemplate(expression)
-        template_context = cls.template_context(record)
-        return template.generate(**template_context).render(encoding='UTF-8')
-
-    @classmethod
-    def _engine_jinja2(cls, expression, record):
+        key = None
+        if self.id is not None and self.id >= 0:
+            key = (self.id, 'program', self._context.get('language'),
+                self.write_date or self.create_date)
+            program = self._compiled_cache.get(key)
+            if program is not None:
+                return program
+        program = self.compile_program()
+        if key is not None:
+            self._compiled_cache.set(key, program)
+        return program
+
+    def compile_program(self):
+        '''Compiles the header and body fields into a render program
+
+        Header fields that are literals are not rendered. The engine may
+        compile the other fields into a single evaluation, otherwise they are
+        rendered one by one with the same template context.
         '''
-        :param expression: Expression to evaluate
-        :param record: Browse record
+        engine = get_engine(self.engine)
+        literals = {}
+        field_names = []
+        for field_name in PROGRAM_FIELDS:
+            expression = getattr(self, field_name)
+            if not expression:
+                continue
+            if engine is None:
+                # The package of the engine is not installed, as eval
+                literals[field_name] = u''
+                continue
+            value = None
+            if field_name not in BODY_FIELDS:
+                value = engine.literal(expression)
+            if value is not None:
+                literals[field_name] = value
+            else:
+                field_names.append(field_name)
+
+        evaluate = None
+        if field_names:
+            try:
+                evaluate = engine.compile_program(self, field_names)
+            except Exception:
+                logger.warning('Unable to compile the render program of '
+                    'template %s', self.id, exc_info=True)
+        if evaluate is None and field_names:
+            compiled = [self.get_compiled(getattr(self, f), f)
+                for f in field_names]
+
+            def evaluate(template_context):
+                return [engine.render(c, template_context) for c in compiled]
+        return RenderProgram(literals, field_names, evaluate)
+
+    def get_prefetch_paths(self):
+        '''Returns the dotted paths to prefetch before rendering
+
+        The paths of the prefetch field are completed with the record paths
+        found in the template expressions.
         '''
-        if not jinja2_loaded or not expression:
-            return u''
+        paths = []
+        if self.prefetch:
+            paths.extend(l.strip() for l in self.prefetch.splitlines())
+        for field_name in EXPRESSION_FIELDS:
+            expression = getattr(self, field_name)
+            if expression:
+                paths.extend(RECORD_PATH.findall(expression))
+        result = []
+        for record_path in paths:
+            record_path = re.sub(r'\[\d+\]', '', record_path).strip('.')
+            if record_path and record_path not in result:
+                result.append(record_path)
+        return result
+
+    def prefetch_records(self, records):
+        '''Loads the prefetch paths for the whole batch of records
+
+        Each hop of a path is read once for all the records reached by the
+        previous hop, so the values are in the transaction cache when the
+        template is evaluated record by record.
+
+        :param records: List of browse records
+        '''
+        for record_path in self.get_prefetch_paths():
+            self._prefetch_path(records, record_path.split('.'))
+
+    @classmethod
+    def _prefetch_path(cls, records, names):
+        if not records or not names:
+            return
+        pool = Pool()
+        name, names = names[0], names[1:]
 
-        template = Jinja2Template(expression)
-        template_context = cls.template_context(record)
-        return template.render(template_context).encode('utf-8')
+        models = OrderedDict()
+        for record in records:
+            if record.id is not None and record.id >= 0:
+                models.setdefault(record.__name__, set()).add(record.id)
+        for model, ids in models.items():
+            Model = pool.get(model)
+            if name not in Model._fields:
+                continue
+            targets = []
+            for record in Model.browse(sorted(ids)):
+                value = getattr(record, name)
+                if isinstance(value, ModelStorage):
+                    targets.append(value)
+                elif isinstance(value, (list, tuple)):
+                    targets.extend(v for v in value
+                        if isinstance(v, ModelStorage))
+            cls._prefetch_path(targets, names)
 
     def render(self, record):
         '''Renders the template and returns as email object
@@ -199,16 +596,156 @@ class Template(ModelSQL, ModelView):
             is to generate the data on
         :return: 'email.message.Message' instance
         '''
-
-        message = MIMEMultipart()
-        message['date'] = formatdate(localtime=1)
-
         language = Transaction().context.get('language', 'en_US')
         if self.language:
-            language = self.eval(self.language, record)
+            language = self.eval(self.language, record, 'language')
 
         with Transaction().set_context(language=language):
+            return self._render(record)
+
+    def render_many(self, records, quarantine=None):
+        '''Renders the template for a batch of records
+
+        The user and base context are built once and the records are grouped
+        by their evaluated language so each language context is entered only
+        once, where the records are browsed again and prefetched. The
+        messages are yielded inside the language context of their record.
+        The recipients are checked before the reports are rendered.
+
+        :param records: List of browse records
+        :param quarantine: List where the records with invalid recipients are
+            appended, with the addresses, instead of raising an error
+        :return: generator of (record, 'email.message.Message') tuples
+        '''
+        records = list(records)
+        template_context = self.template_context(None)
+
+        default_language = Transaction().context.get('language', 'en_US')
+        languages = OrderedDict()
+        for record in records:
+            language = default_language
+            if self.language:
+                with stage('eval.' + self.engine):
+                    language = self.eval(self.language, record, 'language',
+                        template_context)
+            languages.setdefault(language, []).append(record)
+
+        chunk_size = config.getint('electronic_mail_template', 'chunk_size',
+            default=100)
+        for language, language_records in languages.items():
+            with Transaction().set_context(language=language):
+                localized = self.localize_records(language_records)
+                for i in range(0, len(language_records), chunk_size):
+                    chunk = []
+                    for record, local in zip(
+                            language_records[i:i + chunk_size],
+                            localized[i:i + chunk_size]):
+                        values = self.render_values(local,
+                            dict(template_context, record=local), quarantine)
+                        if values is not None:
+                            chunk.append((record, local, values))
+                    reports, encoded = {}, {}
+                    if self.reports and chunk:
+                        reports = self.render_reports_many(
+                            [l for _, l, _ in chunk])
+                    for record, local, values in chunk:
+                        yield record, self._render(local, template_context,
+                            reports.get(record.id), encoded, values)
+
+    def localize_records(self, records):
+        '''Returns the records browsed in the current language context, with
+        their prefetch paths loaded
+
+        The transaction cache depends on the context, so the records are
+        prefetched in the context where they are rendered.
+        '''
+        Model = Pool().get(self.model.model)
+        localized = Model.browse([r.id for r in records])
+        self.prefetch_records(localized)
+        return localized
+
+    def render_digests(self, records, quarantine=None):
+        '''Renders one message for each group of records with the same
+        language, To and CC
+
+        The message is rendered with the first record of the group as record
+        and all of them as records in the template context, and the reports
+        of all the records attached.
+
+        :param records: List of browse records
+        :param quarantine: List where the groups of records with invalid
+            recipients are appended, as render_many does
+        :return: generator of (list of records, 'email.message.Message')
+            tuples
+        '''
+        records = list(records)
+        template_context = self.template_context(None)
 
+        default_language = Transaction().context.get('language', 'en_US')
+        groups = OrderedDict()
+        for record in records:
+            language = default_language
+            with stage('eval.' + self.engine):
+                if self.language:
+                    language = self.eval(self.language, record, 'language',
+                        template_context)
+                key = (language,
+                    self.eval(self.to, record, 'to', template_context),
+                    self.eval(self.cc, record, 'cc', template_context))
+            groups.setdefault(key, []).append(record)
+
+        languages = OrderedDict()
+        for (language, _, _), group in groups.items():
+            languages.setdefault(language, []).extend(group)
+        localized = {}
+        encoded = {}
+        for (language, _, _), group in groups.items():
+            with Transaction().set_context(language=language):
+                if language not in localized:
+                    localized[language] = dict((r.id, r)
+                        for r in self.localize_records(languages[language]))
+                local = [localized[language][r.id] for r in group]
+                group_context = dict(template_context, record=local[0],
+                    records=local)
+                values = self.render_values(local, group_context, quarantine)
+                if values is None:
+                    continue
+                reports = []
+                if self.reports:
+                    rendered = self.render_reports_many(local)
+                    for record in local:
+                        # The record of the report for its file name
+                        reports.extend(r + (record,)
+                            for r in rendered[record.id])
+                yield group, self._render(local[0], group_context, reports,
+                    encoded, values)
+
+    def _render(self, record, template_context=None, reports=None,
+            encoded=None, values=None):
+        '''Renders the template in the current language context
+        :param record: Browse Record of the record on which the template
+            is to generate the data on
+        :param template_context: Base template context shared by a batch
+        :param reports: Reports of the record already rendered, as returned
+            by render_reports, optionally followed by the record of the report
+        :param encoded: Dictionary of base64 attachment payloads by content
+            hash shared by a batch
+        :param values: Values of the fields already returned by render_values
+        :return: 'email.message.Message' instance
+        '''
+        message = MIMEMultipart()
+        message['date'] = formatdate(localtime=1)
+
+        if template_context is None:
+            template_context = self.template_context(record)
+        else:
+            template_context = dict(template_context, record=record)
+        if values is None:
+            values = self.render_values(record, template_context)
+        if self.reports and reports is None:
+            reports = self.render_reports(record)
+
+        with stage('mime'):
             # Simple rendering fields
             simple_fields = {
                 'from_': 'from',
@@ -221,44 +758,33 @@ class Template(ModelSQL, ModelView):
                 'in_reply_to': 'in-reply-to',
                 }
             for field_name in simple_fields.keys():
-                field_expression = getattr(self, field_name)
-                eval_result = self.eval(field_expression, record)
+                eval_result = values.get(field_name)
                 if eval_result:
                     message[simple_fields[field_name]] = eval_result
 
-            if self.reply_to:
-                eval_result = self.eval(self.reply_to, record)
-                if eval_result:
-                    message['reply-to'] = eval_result
+            if values.get('reply_to'):
+                message['reply-to'] = values['reply_to']
 
             # Attach reports
             if self.reports:
-                reports = self.render_reports(record)
                 for report in reports:
-                    ext, data, filename, file_name = report[0:5]
-                    if file_name:
-                        filename = self.eval(file_name, record)
-                    filename = ext and '%s.%s' % (filename, ext) or filename
-                    content_type, _ = mimetypes.guess_type(filename)
-                    maintype, subtype = (
-                        content_type or 'application/octet-stream'
-                        ).split('/', 1)
-
-                    attachment = MIMEBase(maintype, subtype)
-                    attachment.set_payload(data)
-                    Encoders.encode_base64(attachment)
-                    attachment.add_header(
-                        'Content-Disposition', 'attachment', filename=filename)
+                    report_record = report[4] if len(report) > 4 else record
+                    filename = self.report_filename(report, report_record,
+                        template_context)
+                    attachment = self.attachment_part(filename, report[1],
+                        encoded)
                     attachment.add_header(
                         'Content-Transfer-Encoding', 'base64')
                     message.attach(attachment)
 
             # HTML & Text Alternate parts
-            plain = self.eval(self.plain, record)
-            html = self.eval(self.html, record)
+            plain = values.get('plain', u'')
+            html = values.get('html', u'')
             if self.signature:
-                User = Pool().get('res.user')
-                user = User(Transaction().user)
+                user = template_context and template_context.get('user')
+                if user is None:
+                    User = Pool().get('res.user')
+                    user = User(Transaction().user)
                 if user.signature_html:
                     signature = user.signature_html.encode("utf8")
                     html = '%s<br>--<br>%s' % (html, signature)
@@ -269,27 +795,8 @@ class Template(ModelSQL, ModelView):
                         html = '%s<br>--<br>%s' % (html,
                             signature.replace('\n', '<br>'))
 
-            style = ''
-            if self.style:
-                fname = '%s/%s' % (styles_dir(), self.style)
-                with open(fname) as f:
-                    style = f.read()
-                if self.custom_style:
-                    style += '\n%s' % self.custom_style
-            elif self.custom_style:
-                style = '%s' % self.custom_style
-
-            html = """
-                <html>
-                <head><head>
-                <style>
-                %s
-                </style>
-                <body>
-                %s
-                </body>
-                </html>
-                """ % (style, html)
+            prefix, suffix = self.get_html_wrapper()
+            html = prefix + html + suffix
 
             body = MIMEMultipart('alternative')
             charset.add_charset('utf-8', charset.QP, charset.QP)
@@ -299,6 +806,146 @@ class Template(ModelSQL, ModelView):
 
         return message
 
+    def render_values(self, record, template_context, quarantine=None):
+        '''Evaluates the render program and normalizes its recipients
+
+        The To and Cc addresses are validated and deduplicated. If one is not
+        valid, the record and the addresses are appended to the quarantine
+        list, or the recipients error is raised without quarantine.
+
+        :param record: Browse Record, or the list of records of a digest
+        :param template_context: Template context of the record
+        :param quarantine: List of (record, invalid addresses) tuples
+        :return: Dictionary of the values of the fields or None
+        '''
+        with stage('eval.' + self.engine):
+            values = self.get_program().render(template_context)
+        with stage('recipients'):
+            values['to'], values['cc'], _, invalid = normalize_recipients(
+                values.get('to'), values.get('cc'))
+        if invalid:
+            self.invalid_recipients(record, invalid, quarantine)
+            return None
+        return values
+
+    def invalid_recipients(self, record, addresses, quarantine=None):
+        '''Appends the record and its invalid addresses to the quarantine
+        list or raises the recipients error if there is no quarantine
+        '''
+        if quarantine is not None:
+            quarantine.append((record, addresses))
+            return
+        records = record if isinstance(record, list) else [record]
+        self.raise_user_error('recipients_error',
+            error_description='invalid_recipients',
+            error_description_args={
+                'record': ', '.join(r.rec_name for r in records),
+                'addresses': ', '.join(addresses),
+                })
+
+    def render_chunk(self, ids):
+        '''Renders the template for the record ids and serializes the messages
+
+        :param ids: List of record ids
+        :return: List of (record id, message string, invalid addresses)
+            tuples, the message is None if the recipients are not valid
+        '''
+        Model = Pool().get(self.model.model)
+        quarantine = []
+        result = [(r.id, m.as_string(), None)
+            for r, m in self.render_many(Model.browse(ids), quarantine)]
+        result.extend((r.id, None, a) for r, a in quarantine)
+        return result
+
+    def render_parallel(self, records, processes=None, chunk_size=None,
+            quarantine=None):
+        '''Renders the template for a batch of records in worker processes
+
+        The record ids are split in chunks rendered by a pool of processes,
+        each one with its own transaction, so only committed data is seen.
+        The messages are streamed back chunk by chunk as they are rendered.
+        With one process, or on a memory database, the chunks are rendered
+        in this process through the same serialization.
+
+        :param records: List of browse records
+        :param quarantine: List where the records with invalid recipients are
+            appended, as render_many does
+        :return: generator of (record, 'email.message.Message') tuples
+        '''
+        if processes is None:
+            processes = config.getint('electronic_mail_template', 'processes',
+                default=0)
+        if chunk_size is None:
+            chunk_size = config.getint('electronic_mail_template',
+                'chunk_size', default=100)
+        records = list(records)
+        transaction = Transaction()
+        database_name = transaction.database.name
+        id2record = dict((r.id, r) for r in records)
+        chunks = [(database_name, transaction.user, transaction.context,
+                self.id, [r.id for r in records[i:i + chunk_size]])
+            for i in range(0, len(records), chunk_size)]
+
+        if processes > 1 and database_name != ':memory:':
+            pool = multiprocessing.Pool(min(processes, len(chunks)),
+                _init_render_worker)
+            try:
+                results = pool.imap(_render_worker, chunks)
+                for result in results:
+                    for item in self._load_chunk(result, id2record,
+                            quarantine):
+                        yield item
+                pool.close()
+            finally:
+                pool.terminate()
+                pool.join()
+        else:
+            for chunk in chunks:
+                for item in self._load_chunk(self.render_chunk(chunk[-1]),
+                        id2record, quarantine):
+                    yield item
+
+    def _load_chunk(self, result, id2record, quarantine=None):
+        'Parses the messages of a chunk returned by render_chunk'
+        for record_id, data, invalid in result:
+            record = id2record[record_id]
+            if data is None:
+                self.invalid_recipients(record, invalid, quarantine)
+                continue
+            yield record, message_from_string(data)
+
+    def render_messages(self, records, quarantine=None):
+        '''Renders the template for a batch of records, in worker processes
+        if the template is in parallel mode and the batch is large enough
+
+        :param records: List of browse records
+        :param quarantine: List where the records with invalid recipients are
+            appended, as render_many does
+        :return: generator of (record, 'email.message.Message') tuples, or of
+            (list of records, 'email.message.Message') for digest templates
+        '''
+        if self.digest:
+            return self.render_digests(records, quarantine)
+        processes = config.getint('electronic_mail_template', 'processes',
+            default=0)
+        chunk_size = config.getint('electronic_mail_template', 'chunk_size',
+            default=100)
+        if (self.parallel and processes > 1
+                and len(records) > chunk_size
+                and Transaction().context.get('_email_template_parallel',
+                    True)):
+            return self.render_parallel(records, processes, chunk_size,
+                quarantine)
+        return self.render_many(records, quarantine)
+
+    def report_actions(self):
+        '''Returns the report actions to render, none if the context has
+        _email_template_reports set to False
+        '''
+        if Transaction().context.get('_email_template_reports', True):
+            return self.reports
+        return []
+
     def render_reports(self, record):
         '''Renders the reports and returns as a list of tuple
 
@@ -311,57 +958,499 @@ class Template(ModelSQL, ModelView):
             the report file name (optional)
         '''
         reports = []
-        for report_action in self.reports:
-            report = Pool().get(report_action.report_name, type='report')
-            reports.append([report.execute([record.id], {'id': record.id}),
-                report_action.file_name])
+        for report_action in self.report_actions():
+            with stage('report.' + report_action.report_name) as report_stage:
+                output = self.execute_report(report_action, record)
+                report_stage.size = len(output[1] or b'')
+            reports.append([output, report_action.file_name])
 
         # The boolean for direct print in the tuple is useless for emails
         return [(r[0][0], r[0][1], r[0][3], r[1]) for r in reports]
 
-    def render_and_send(self, records):
+    def report_filename(self, report, record, template_context=None):
+        '''Returns the attachment file name of a report tuple as returned by
+        render_reports
+        '''
+        ext, data, filename, file_name = report[0:5]
+        if file_name:
+            filename = self.eval(file_name, record,
+                template_context=template_context)
+        return ext and '%s.%s' % (filename, ext) or filename
+
+    def render_stream(self, record, fileobj=None):
+        '''Renders the template into a file object
+
+        Unlike render, the message is not built in memory: the attachments
+        are base64 encoded chunk by chunk straight into the file, so the
+        memory used does not grow with their encoded size.
+
+        :param record: Browse Record of the record on which the template
+            is to generate the data on
+        :param fileobj: File object to write to, a spooled temporary file by
+            default
+        :return: The file object positioned at its start
+        '''
+        language = Transaction().context.get('language', 'en_US')
+        if self.language:
+            language = self.eval(self.language, record, 'language')
+
+        with Transaction().set_context(language=language):
+            attachments = []
+            if self.reports:
+                attachments = [(self.report_filename(r, record), r[1])
+                    for r in self.render_reports(record)]
+            message = self._render(record, reports=[])
+        return self.write_message(message, attachments, fileobj)
+
+    @classmethod
+    def write_message(cls, message, attachments, fileobj=None):
+        '''Writes the message into a file object with the attachments added
+        before its body, as render does
+
+        :param message: 'email.message.Message' instance without attachments
+        :param attachments: List of (file name, data) tuples
+        :param fileobj: File object to write to, a spooled temporary file by
+            default
+        :return: The file object positioned at its start
+        '''
+        if fileobj is None:
+            fileobj = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
+        text = message.as_string()
+        delimiter = '--%s\n' % message.get_boundary()
+        index = text.index(delimiter)
+        fileobj.write(text[:index])
+        for filename, data in attachments:
+            attachment = cls.attachment_part(filename, '')
+            attachment.add_header('Content-Transfer-Encoding', 'base64')
+            fileobj.write(delimiter)
+            fileobj.write(attachment.as_string())
+            for i in range(0, len(data), BASE64_CHUNK_SIZE):
+                if i:
+                    fileobj.write('\n')
+                encoded = base64.b64encode(data[i:i + BASE64_CHUNK_SIZE])
+                fileobj.write('\n'.join(encoded[j:j + 76]
+                        for j in range(0, len(encoded), 76)))
+            fileobj.write('\n')
+        fileobj.write(text[index:])
+        fileobj.seek(0)
+        return fileobj
+
+    def render_reports_many(self, records):
+        '''Renders the reports of a batch of records
+
+        Each report is executed once for all the records not in the report
+        cache when the report class provides execute_many(ids, data),
+        returning the list of report tuples of each id, otherwise once per
+        record.
+
+        :param records: List of browse records
+        :return: Dictionary of record id and list of tuples as returned by
+            render_reports
+        '''
+        result = dict((r.id, []) for r in records)
+        for report_action in self.report_actions():
+            with stage('report.' + report_action.report_name) as report_stage:
+                outputs = self.execute_reports(report_action, records)
+                report_stage.size = sum(len(o[1] or b'') for _, o in outputs)
+            for record, output in outputs:
+                # The boolean for direct print is useless for emails
+                result[record.id].append((output[0], output[1], output[3],
+                        report_action.file_name))
+        return result
+
+    @classmethod
+    def execute_reports(cls, report_action, records):
+        '''Executes the report action on the records
+
+        :return: List of (record, report tuple) in the records order
+        '''
+        report = Pool().get(report_action.report_name, type='report')
+        if not hasattr(report, 'execute_many'):
+            return [(r, cls.execute_report(report_action, r))
+                for r in records]
+
+        cache = report_cache()
+        keys = dict((r.id, cls._report_cache_key(report_action, r))
+            for r in records)
+        outputs = {}
+        if cache is not None:
+            for record in records:
+                output = cache.get(keys[record.id])
+                if output is not None:
+                    outputs[record.id] = output
+        ids = [r.id for r in records if r.id not in outputs]
+        if ids:
+            for record_id, output in zip(ids,
+                    report.execute_many(ids, {})):
+                outputs[record_id] = output
+                if cache is not None:
+                    cache.set(keys[record_id], output)
+        return [(r, outputs[r.id]) for r in records]
+
+    @staticmethod
+    def _report_cache_key(report_action, record):
+        return (report_action.id,
+            report_action.write_date or report_action.create_date,
+            record.__name__, record.id,
+            getattr(record, 'write_date', None)
+            or getattr(record, 'create_date', None),
+            Transaction().language)
+
+    @classmethod
+    def execute_report(cls, report_action, record):
+        '''Executes the report action on the record
+
+        The output is taken from the report cache, if enabled, while the
+        report action and the record are not modified.
+        '''
+        report = Pool().get(report_action.report_name, type='report')
+        cache = report_cache()
+        if cache is None:
+            return report.execute([record.id], {'id': record.id})
+
+        key = cls._report_cache_key(report_action, record)
+        result = cache.get(key)
+        if result is None:
+            result = report.execute([record.id], {'id': record.id})
+            cache.set(key, result)
+        return result
+
+    def render_and_send(self, records, sent=None):
         """
         Render the template and send
         :param records: List Object of the records
+        :param sent: List of the records already sent, whose mails are stored
+            but not sent again, where the records sent are appended
+        :return: List of the records quarantined for invalid recipients
         """
         pool = Pool()
+        TemplateStats = pool.get('electronic.mail.template.stats')
+
+        mailbox = self.get_mailbox()
+        if not mailbox:
+            logger.warning('Not configured mailbox for email template: %s' %
+                self.rec_name)
+            return []
+
+        records = list(records)
+        with instrument(self) as batch_stats:
+            quarantined = self._render_and_send(records, mailbox, sent)
+        if batch_stats is not None:
+            batch_stats.records = len(records)
+            TemplateStats.record(batch_stats)
+        return quarantined
+
+    def _render_and_send(self, records, mailbox, sent_records=None):
+        '''Renders, stores and sends the mails of the records in chunks
+
+        The records with invalid recipients are not sent but kept as failed
+        jobs, the Bcc addresses already in To or Cc are dropped.
+        '''
+        pool = Pool()
         ElectronicMail = pool.get('electronic.mail')
-        EmailConfiguration = pool.get('electronic.mail.configuration')
 
+        chunk_size = config.getint('electronic_mail_template', 'chunk_size',
+            default=100)
+        session = None
+        if not self.queue:
+            session = self.get_smtp_session()
+        template_context = self.template_context(None)
         activities = []
+        sent = []
+        messages = []
+        quarantine = []
+        try:
+            for record, email_message in self.render_messages(records,
+                    quarantine):
+                context = {}
+                bcc_record, bcc_context = record, template_context
+                if isinstance(record, list):
+                    # A digest of records
+                    bcc_record = record[0]
+                    bcc_context = dict(template_context, records=record)
+                field_expression = getattr(self, 'bcc')
+                with stage('eval.' + self.engine):
+                    eval_result = self.eval(field_expression, bcc_record,
+                        'bcc', bcc_context)
+                if eval_result:
+                    with stage('recipients'):
+                        _, _, eval_result, invalid = normalize_recipients(
+                            email_message['to'], email_message['cc'],
+                            eval_result)
+                    if invalid:
+                        self.invalid_recipients(record, invalid, quarantine)
+                        continue
+                if eval_result:
+                    context['bcc'] = eval_result
+                messages.append((record, email_message, context))
+                if len(messages) >= chunk_size:
+                    sent.extend(self._persist_and_send(messages, mailbox,
+                            session, activities, sent_records))
+                    messages = []
+            if messages:
+                sent.extend(self._persist_and_send(messages, mailbox, session,
+                        activities, sent_records))
+        finally:
+            if session:
+                session.close()
+                logger.info('Sent %(messages)s emails over '
+                    '%(connections)s SMTP connections' % session.stats())
+            if sent:
+                ElectronicMail.write(sent, {'flag_send': True})
+
+        if activities:
+            with stage('activities'):
+                self.add_activities(activities)  # add activities
+        return self.quarantine(quarantine)
+
+    def render_and_send_each(self, records):
+        '''Renders and sends the records as render_and_send, isolating the
+        records that fail
+
+        If the batch fails, it is rolled back to a savepoint, the records
+        that fail to render are left out and the others are sent again. The
+        mails sent over SMTP before the failure are stored but not sent
+        again.
+
+        :param records: List Object of the records
+        :return: Tuple of the list of the records quarantined and the
+            dictionary of record id and error of the records not sent
+        '''
+        sent = []
+        try:
+            return self.send_savepoint(records, sent), {}
+        except Exception:
+            logger.error('Email template %s failed for records %s',
+                self.id, [r.id for r in records], exc_info=True)
+
+        sent_ids = set(r.id for r in sent)
+        errors = {}
         for record in records:
-            email_message = self.render(record)
-
-            context = {}
-            field_expression = getattr(self, 'bcc')
-            eval_result = self.eval(field_expression, record)
-            if eval_result:
-                context['bcc'] = eval_result
-            email_configuration = EmailConfiguration(1)
-            if self.queue:
-                mailbox = self.mailbox_outbox \
-                    if self.mailbox_outbox else email_configuration.outbox
+            if record.id in sent_ids:
+                continue
+            try:
+                self.render(record)
+            except Exception:
+                errors[record.id] = traceback.format_exc()
+                logger.warning('Email template %s failed for record %s',
+                    self.id, record.id, exc_info=True)
+        valid = [r for r in records if r.id not in errors]
+        try:
+            return self.send_savepoint(valid, sent), errors
+        except Exception:
+            error = traceback.format_exc()
+            logger.error('Email template %s failed for records %s',
+                self.id, [r.id for r in valid], exc_info=True)
+        sent_ids = set(r.id for r in sent)
+        for record in valid:
+            if record.id not in sent_ids:
+                errors[record.id] = error
             else:
-                mailbox = self.mailbox if self.mailbox \
-                    else email_configuration.sent
+                logger.warning('Email template %s sent record %s but its '
+                    'mail is not stored', self.id, record.id)
+        return [], errors
+
+    def send_savepoint(self, records, sent):
+        '''Renders and sends the records, rolled back to a savepoint on error
+        '''
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+        cursor.execute('SAVEPOINT email_template_send')
+        try:
+            result = self.render_and_send(records, sent)
+        except Exception:
+            cursor.execute('ROLLBACK TO SAVEPOINT email_template_send')
+            transaction.cache.clear()
+            raise
+        cursor.execute('RELEASE SAVEPOINT email_template_send')
+        return result
+
+    def quarantine(self, quarantine):
+        '''Keeps the records with invalid recipients as failed jobs
+        :param quarantine: List of (record, invalid addresses) tuples, the
+            record is a list of records for digests
+        :return: List of the records
+        '''
+        Job = Pool().get('electronic.mail.template.job')
+
+        errors = []
+        for record, addresses in quarantine:
+            records = record if isinstance(record, list) else [record]
+            logger.warning('Invalid recipients %s for records: %s',
+                ', '.join(addresses), ', '.join(str(r.id) for r in records))
+            error = self.raise_user_error('invalid_recipients', {
+                    'record': ', '.join(r.rec_name for r in records),
+                    'addresses': ', '.join(addresses),
+                    }, raise_exception=False)
+            errors.extend((r, error) for r in records)
+        if errors:
+            Job.create_failed(self, errors)
+        return [r for r, _ in errors]
+
+    def send_bulk(self, domain=None, ids=None):
+        """
+        Render the template and send to many records, chunk by chunk,
+        resuming from the checkpoint if interrupted
+        The pending changes of the transaction are committed with the
+        checkpoint, then each chunk, unless the context has
+        _email_template_commit set to False
+        :param domain: Domain of the records
+        :param ids: Iterator of the record ids, instead of the domain
+        :return: electronic.mail.template.bulk instance of the checkpoint
+        """
+        Bulk = Pool().get('electronic.mail.template.bulk')
+        return Bulk.start(self, domain=domain, ids=ids)
+
+    def preview(self, records=None, domain=None, limit=10, reports=True):
+        """
+        Render the template as sent, without storing or sending the mails
+        :param records: List Object of the records
+        :param domain: Domain of a sample of the records, instead of records
+        :param limit: Number of records of the domain sample
+        :param reports: False to not execute the reports
+        :return: Dictionary with the headers, body and attachment sizes of
+            each message, the records quarantined and the stage timings
+        """
+        if records is None:
+            Model = Pool().get(self.model.model)
+            records = Model.search(domain or [], limit=limit)
+        records = list(records)
+
+        def ids(record):
+            records = record if isinstance(record, list) else [record]
+            return [r.id for r in records]
+
+        messages = []
+        quarantine = []
+        with Transaction().set_context(_email_template_parallel=False,
+                _email_template_reports=reports):
+            with instrument(self, force=True) as batch_stats:
+                for record, message in self.render_messages(records,
+                        quarantine):
+                    with stage('serialize') as serialize_stage:
+                        size = len(message.as_string())
+                        serialize_stage.size = size
+                    messages.append(self.preview_message(ids(record),
+                            message, size))
+        batch_stats.records = len(records)
+        return {
+            'messages': messages,
+            'quarantined': [{
+                    'records': ids(r),
+                    'addresses': a,
+                    } for r, a in quarantine],
+            'stats': batch_stats.as_dict(),
+            }
 
-            electronic_email = ElectronicMail.create_from_email(
-                email_message, mailbox, context)
-            if not electronic_email: # not configured mailbox
-                return
+    @staticmethod
+    def preview_message(record_ids, message, size):
+        '''Returns the description of a rendered message for preview
+        '''
+        result = {
+            'records': record_ids,
+            'headers': OrderedDict(message.items()),
+            'size': size,
+            'plain': 0,
+            'html': 0,
+            'attachments': [],
+            }
+        for part in message.walk():
+            if part.is_multipart():
+                continue
+            payload = part.get_payload(decode=True) or b''
+            filename = part.get_filename()
+            if filename:
+                result['attachments'].append((filename, len(payload)))
+            elif part.get_content_type() == 'text/plain':
+                result['plain'] += len(payload)
+            elif part.get_content_type() == 'text/html':
+                result['html'] += len(payload)
+        return result
+
+    def get_mailbox(self):
+        '''Returns the mailbox where the mails of the template are stored
+        '''
+        EmailConfiguration = Pool().get('electronic.mail.configuration')
+        if self.queue:
+            return self.mailbox_outbox or EmailConfiguration(1).outbox
+        return self.mailbox or EmailConfiguration(1).sent
+
+    def _persist_and_send(self, messages, mailbox, session, activities,
+            sent_records=None):
+        '''Stores a chunk of rendered messages and sends them unless queued
+
+        :param messages: List of (record, message, context) tuples, the
+            record is a list of records for digests
+        :param activities: List where the activities to add are appended
+        :param sent_records: List of the records already sent, not sent
+            again, where the records sent are appended
+        :return: List of the electronic mails to flag as sent
+        '''
+        ElectronicMail = Pool().get('electronic.mail')
+
+        sent_ids = set()
+        if sent_records is not None:
+            sent_ids = set(r.id for r in sent_records)
+
+        with stage('persist'):
+            electronic_emails = ElectronicMail.create_from_emails(
+                [m for _, m, _ in messages], mailbox,
+                [c for _, _, c in messages])
+        sent = []
+        for (record, email_message, context), electronic_email in zip(
+                messages, electronic_emails):
+            records = record if isinstance(record, list) else [record]
             if not self.queue:
-                electronic_email.send_email()
+                if all(r.id in sent_ids for r in records):
+                    # Sent before a failure that rolled its mail back
+                    sent.append(electronic_email)
+                elif session:
+                    self.send_message(session, email_message,
+                        context.get('bcc'))
+                    sent.append(electronic_email)
+                else:
+                    with stage('smtp'):
+                        electronic_email.send_email()
+                if sent_records is not None:
+                    sent_records.extend(records)
                 logger.info('Send email: %s' %
                     (electronic_email.rec_name))
-                activities.append({
-                    'record': record,
-                    'template': self,
-                    'mail': electronic_email,
-                    })
+                activities.extend({
+                        'record': r,
+                        'template': self,
+                        'mail': electronic_email,
+                        } for r in records)
+        return sent
 
-        if activities:
-            self.add_activities(activities)  # add activities
-        return
+    @classmethod
+    def get_smtp_session(cls):
+        '''Returns an SMTP session on the server of the electronic mails
+        shared by all the messages of a batch, or None if there is no server
+        '''
+        SMTPServer = Pool().get('smtp.server')
+        server = SMTPServer.get_smtp_server_from_model('electronic.mail')
+        if not server:
+            return
+        return SMTPSession(server.get_smtp_server,
+            max_messages=config.getint('electronic_mail_template',
+                'smtp_session_messages', default=100))
+
+    @staticmethod
+    def send_message(session, message, bcc=None):
+        '''Sends the rendered message over the SMTP session
+        :param session: SMTPSession instance
+        :param message: 'email.message.Message' instance
+        :param bcc: Blind carbon copy recipients
+        '''
+        addresses = message.get_all('to', []) + message.get_all('cc', [])
+        if bcc:
+            addresses.append(bcc)
+        recipients = [a for _, a in getaddresses(addresses) if a]
+        from_ = parseaddr(message.get('from', ''))[1]
+        data = message.as_string()
+        with stage('smtp') as smtp_stage:
+            smtp_stage.size = len(data)
+            return session.sendmail(from_, recipients, data)
 
     @classmethod
     def mail_from_trigger(cls, records, trigger_id):
@@ -371,12 +1460,16 @@ class Template(ModelSQL, ModelView):
         The process involves identifying the tempalte which needs
         to be pulled when the trigger is.
 
+        The records are collected for the transaction and sent when it is
+        committed, once per template and record.
+
         :param records: Object of the records
         :param trigger_id: ID of the trigger
         """
         Trigger = Pool().get('ir.trigger')
         trigger = Trigger(trigger_id)
-        return trigger.email_template.render_and_send(records)
+        datamanager = Transaction().join(TriggerDataManager())
+        datamanager.put(trigger.email_template, records)
 
     @classmethod
     def add_activities(cls, records):
@@ -384,23 +1477,21 @@ class Template(ModelSQL, ModelView):
         Add activities related to party
         :param records: {'record', 'template', 'mail'}
         """
-        cursor = Transaction().connection.cursor()
-        cursor.execute(
-            "SELECT state "
-            "from ir_module "
-            "where state='installed' and name = 'activity'")
-        activity_installed = cursor.fetchall()
-        if not activity_installed:
-            return
-
         pool = Pool()
-        Activity = pool.get('activity.activity')
+        try:
+            Activity = pool.get('activity.activity')
+        except KeyError:
+            # The pool only holds the models of the installed modules
+            return
         ActivityType = pool.get('activity.type')
-        ActivityReference = pool.get('activity.reference')
         ModelData = pool.get('ir.model.data')
         Party = pool.get('party.party')
         User = pool.get('res.user')
 
+        records = [r for r in records if r['template'].activity]
+        if not records:
+            return
+
         type_id = ActivityType(ModelData.get_id(
             'activity', 'outgoing_email_type'))
 
@@ -409,42 +1500,68 @@ class Template(ModelSQL, ModelView):
         if not employee and user:
             employee = user.employee
 
-        activities = []
+        template_contexts = {}
+        values = []
         for r in records:
             record = r['record']
             template = r['template']
-            mail = r['mail']
 
-            if template.activity:
-                activity = Activity()
-                activity.activity_type = type_id
-                activity.subject = mail.subject
-                activity.description = mail.body_plain
-                activity.state = 'held'
-                activity.employee = employee
+            resource_model = cls.get_activity_resource_model(template.model)
+            if not resource_model:
+                continue
+            if template not in template_contexts:
+                template_contexts[template] = template.template_context(None)
+            party = template.eval(template.activity, record, 'activity',
+                template_contexts[template])
+            if isinstance(party, ModelStorage):
+                party = party.id
+            values.append((r, resource_model, int(party) if party else None))
 
-                party = template.eval(template.activity, record)
-                if party:
-                    activity.party = Party(party)
+        parties = dict((p.id, p) for p in Party.browse(
+                list(set(v[2] for v in values if v[2]))))
 
-                resources = ActivityReference.search([
-                    ('model', '=', template.model)
-                    ])
-                if not resources:
-                    continue
-                resource, = resources
-                activity.resource = '%s,%s' % (
-                    resource.model.model,
-                    record.id)
-
-                activities.append(activity)
+        activities = []
+        for r, resource_model, party in values:
+            mail = r['mail']
+            activity = Activity()
+            activity.activity_type = type_id
+            activity.subject = mail.subject
+            activity.description = mail.body_plain
+            activity.state = 'held'
+            activity.employee = employee
+            if party:
+                activity.party = parties[party]
+            activity.resource = '%s,%s' % (resource_model, r['record'].id)
+            activities.append(activity)
 
         if activities:
             Activity.save(activities)
 
+    @classmethod
+    def get_activity_resource_model(cls, model):
+        '''Returns the name of the activity reference model of the template
+        model or None
+
+        The result is cached until an activity reference is modified, an
+        empty string standing for no reference model.
+        '''
+        resource_model = cls._activity_reference_cache.get(model.id)
+        if resource_model is None:
+            ActivityReference = Pool().get('activity.reference')
+            resources = ActivityReference.search([
+                    ('model', '=', model.id),
+                    ])
+            resource_model = ''
+            if resources:
+                resource, = resources
+                resource_model = resource.model.model
+            cls._activity_reference_cache.set(model.id, resource_model)
+        return resource_model or None
+
     def get_attachments(self, records):
         record_ids = [r.id for r in records]
         attachments = []
+        encoded = {}
         for report in self.reports:
             report = Pool().get(report.report_name, type='report')
             ext, data, filename, file_name = report.execute(record_ids, {})
@@ -452,18 +1569,64 @@ class Template(ModelSQL, ModelView):
             if file_name:
                 filename = self.eval(file_name, record_ids).decode('utf-8')
             filename = ext and '%s.%s' % (filename, ext) or filename
-            content_type, _ = mimetypes.guess_type(filename)
-            maintype, subtype = (
-                content_type or 'application/octet-stream'
-                ).split('/', 1)
+            attachments.append(self.attachment_part(filename, data, encoded))
+        return attachments
 
-            attachment = MIMEBase(maintype, subtype)
+    @staticmethod
+    def attachment_part(filename, data, encoded=None):
+        '''Returns the MIME part of the attachment
+
+        :param filename: File name of the attachment
+        :param data: Content of the attachment
+        :param encoded: Dictionary of base64 payloads by content hash shared
+            by a batch, so identical contents are encoded once
+        :return: 'email.mime.base.MIMEBase' instance
+        '''
+        content_type, _ = mimetypes.guess_type(filename)
+        maintype, subtype = (
+            content_type or 'application/octet-stream'
+            ).split('/', 1)
+
+        attachment = MIMEBase(maintype, subtype)
+        digest = None
+        if encoded is not None:
+            digest = hashlib.sha1(data).hexdigest()
+        if digest and digest in encoded:
+            attachment.set_payload(encoded[digest])
+            attachment['Content-Transfer-Encoding'] = 'base64'
+        else:
             attachment.set_payload(data)
             Encoders.encode_base64(attachment)
-            attachment.add_header(
-                'Content-Disposition', 'attachment', filename=filename)
-            attachments.append(attachment)
-        return attachments
+            if digest:
+                encoded[digest] = attachment.get_payload()
+        attachment.add_header(
+            'Content-Disposition', 'attachment', filename=filename)
+        return attachment
+
+
+class RenderProgram(object):
+    '''Renders the header and body fields of a template in one evaluation
+    '''
+
+    def __init__(self, literals, field_names, evaluate):
+        '''
+        :param literals: Dictionary of the values of the literal fields
+        :param field_names: Names of the fields rendered by evaluate
+        :param evaluate: Function returning the list of values of the fields
+            for a template context
+        '''
+        self.literals = literals
+        self.field_names = field_names
+        self.evaluate = evaluate
+
+    def render(self, template_context):
+        '''Returns the dictionary of the values of the fields
+        '''
+        values = dict(self.literals)
+        if self.field_names:
+            values.update(zip(self.field_names,
+                    self.evaluate(template_context)))
+        return values
 
 
 class TemplateReport(ModelSQL):
@@ -476,3 +1639,17 @@ class TemplateReport(ModelSQL):
     @classmethod
     def check_xml_record(cls, records, values):
         return True
+
+
+class TemplateCompiled(ModelSQL):
+    'Email Template Compiled Expression'
+    __name__ = 'electronic.mail.template.compiled'
+
+    template = fields.Many2One('electronic.mail.template', 'Template',
+        required=True, ondelete='CASCADE', select=True)
+    field = fields.Char('Field', required=True)
+    language = fields.Char('Language')
+    engine = fields.Char('Engine', required=True)
+    python = fields.Char('Python', required=True)
+    digest = fields.Char('Digest', required=True)
+    code = fields.Binary('Code', required=True)
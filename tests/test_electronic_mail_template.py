@@ -1,18 +1,1031 @@
 # This file is part of the electronic_mail_template module for Tryton.
 # The COPYRIGHT file at the top level of this repository contains the full
 # copyright notices and license terms.
+import asyncore
+import os
+import shutil
+import smtpd
+import smtplib
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
 import unittest
+from email import message_from_string
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
 import trytond.tests.test_tryton
-from trytond.tests.test_tryton import ModuleTestCase
+from trytond.tests.test_tryton import ModuleTestCase, with_transaction, \
+    DB_NAME
+from trytond.config import config
+from trytond.pool import Pool
+from trytond.transaction import Transaction
+from trytond.exceptions import UserError
+from trytond.report import Report
+from trytond.modules.electronic_mail_template.cache import FileCache
+from trytond.modules.electronic_mail_template import engine as \
+    template_engine
+from trytond.modules.electronic_mail_template.engine import get_engine, \
+    GenshiEngine
+from trytond.modules.electronic_mail_template.outbox import OutboxDrain, \
+    RateLimiter, smtp_connector
+from trytond.modules.electronic_mail_template.recipients import \
+    normalize_recipients
+from trytond.modules.electronic_mail_template.session import SMTPSession
+from trytond.modules.electronic_mail_template import template as \
+    template_module
+from trytond.modules.electronic_mail_template.stats import instrument, stage
+from trytond.modules.electronic_mail_template.trigger import \
+    TriggerDataManager
+
+
+class SMTPSink(smtpd.SMTPServer):
+    'SMTP server keeping the received messages'
+
+    def __init__(self):
+        smtpd.SMTPServer.__init__(self, ('127.0.0.1', 0), None)
+        self.port = self.socket.getsockname()[1]
+        self.messages = []
+        # Recipients whose messages are refused temporarily
+        self.refused = set()
+        self.running = True
+        self.thread = threading.Thread(target=self.serve)
+        self.thread.start()
+
+    def serve(self):
+        while self.running:
+            asyncore.loop(timeout=0.05, count=1)
+
+    def stop(self):
+        self.running = False
+        self.thread.join()
+        self.close()
+
+    def process_message(self, peer, mailfrom, rcpttos, data, **kwargs):
+        if self.refused & set(rcpttos):
+            return '451 Try again later'
+        self.messages.append((mailfrom, rcpttos, data))
+
+    def connect(self):
+        return smtplib.SMTP('127.0.0.1', self.port)
+
+
+class BatchReport(Report):
+    'Report executed once for many records'
+    __name__ = 'electronic_mail_template.batch_report'
+    # Seconds spent by each execution, as loading the report template
+    overhead = 0
+    calls = []
+
+    @classmethod
+    def render_record(cls, record_id):
+        return ('txt', ('Report %s' % record_id).encode('ascii'), False,
+            'Report')
+
+    @classmethod
+    def execute(cls, ids, data):
+        cls.calls.append(list(ids))
+        time.sleep(cls.overhead)
+        return cls.render_record(ids[0])
+
+    @classmethod
+    def execute_many(cls, ids, data):
+        cls.calls.append(list(ids))
+        time.sleep(cls.overhead)
+        return [cls.render_record(i) for i in ids]
+
+
+def add_batch_report(model):
+    '''Registers BatchReport in the pool and returns a report action of the
+    model using it, and the callable unregistering it
+    '''
+    pool = Pool()
+    ActionReport = pool.get('ir.action.report')
+
+    BatchReport.__setup__()
+    BatchReport.__post_setup__()
+    pool.add(BatchReport, type='report')
+    reports = Pool._pool[pool.database_name]['report']
+    action, = ActionReport.create([{
+                'name': 'Batch',
+                'model': model,
+                'report_name': BatchReport.__name__,
+                }])
+    return action, lambda: reports.pop(BatchReport.__name__, None)
 
 
 class ElectronicMailTemplateTestCase(ModuleTestCase):
     'Test Electronic Mail Template module'
     module = 'electronic_mail_template'
 
+    def create_template(self, **values):
+        pool = Pool()
+        Model = pool.get('ir.model')
+        Template = pool.get('electronic.mail.template')
+
+        model, = Model.search([('model', '=', 'res.user')])
+        template_values = {
+            'name': 'Test',
+            'model': model.id,
+            'engine': 'genshi',
+            'from_': 'admin@example.com',
+            'to': '${record.login}@example.com',
+            'subject': 'Hello ${record.name}',
+            'plain': 'Dear ${record.name}',
+            'html': '<p>Dear ${record.name}</p>',
+            }
+        template_values.update(values)
+        template, = Template.create([template_values])
+        return template
+
+    @with_transaction()
+    def test_compiled_cache(self):
+        'Test compiled template cache'
+        pool = Pool()
+        Template = pool.get('electronic.mail.template')
+        User = pool.get('res.user')
+
+        admin, = User.search([('login', '=', 'admin')])
+        for engine, subject in (
+                ('python', '"Hello " + record.name'),
+                ('genshi', 'Hello ${record.name}'),
+                ('jinja2', 'Hello {{ record.name }}'),
+                ):
+            template = self.create_template(engine=engine, subject=subject)
+            stats = Template.compiled_cache_stats()
+            self.assertEqual(
+                template.eval(template.subject, admin, 'subject'),
+                'Hello %s' % admin.name)
+            self.assertEqual(Template.compiled_cache_stats()['misses'],
+                stats['misses'] + 1)
+            self.assertEqual(
+                template.eval(template.subject, admin, 'subject'),
+                'Hello %s' % admin.name)
+            self.assertEqual(Template.compiled_cache_stats()['hits'],
+                stats['hits'] + 1)
+
+    @with_transaction()
+    def test_compile_on_save(self):
+        'Test expressions are validated and compiled when saved'
+        pool = Pool()
+        Template = pool.get('electronic.mail.template')
+        Compiled = pool.get('electronic.mail.template.compiled')
+        User = pool.get('res.user')
+
+        admin, = User.search([('login', '=', 'admin')])
+        for engine, subject, invalid in (
+                ('python', '"Hello " + record.name', '"Hello " +'),
+                ('genshi', 'Hello ${record.name}', 'Hello ${record.name'),
+                ('jinja2', 'Hello {{ record.name }}', 'Hello {{ record.'),
+                ):
+            template = self.create_template(engine=engine, subject=subject)
+            self.assertRaises(UserError, Template.write, [template], {
+                    'subject': invalid,
+                    })
+            stored = Compiled.search([
+                    ('template', '=', template.id),
+                    ('field', '=', 'subject'),
+                    ])
+            if engine == 'python':
+                self.assertEqual(len(stored), 1)
+                compiled = template.load_compiled(template.subject,
+                    'subject')
+                self.assertEqual(get_engine('python').render(compiled,
+                        Template.template_context(admin)),
+                    'Hello %s' % admin.name)
+                self.assertEqual(template.load_compiled('Other', 'subject'),
+                    None)
+            else:
+                self.assertEqual(stored, [])
+
+    @with_transaction()
+    def test_jinja2_loader(self):
+        'Test Jinja2 templates are loaded from the template fields'
+        pool = Pool()
+        Template = pool.get('electronic.mail.template')
+        User = pool.get('res.user')
+
+        admin, = User.search([('login', '=', 'admin')])
+        template = self.create_template(engine='jinja2',
+            subject='Hello {{ record.name }}')
+        engine = get_engine('jinja2')
+        compiled = engine.compile_field(template, 'subject')
+        self.assertEqual(compiled.name,
+            template.jinja2_template_name('subject'))
+        self.assertEqual(engine.render(compiled,
+                Template.template_context(admin)),
+            'Hello %s' % admin.name)
+
+        directory = engine.environment.bytecode_cache.directory
+        files = len(os.listdir(directory))
+        name = template.jinja2_template_name('subject')
+        Template.write([template], {
+                'subject': 'Hi {{ record.name }}',
+                })
+        template = Template(template.id)
+        self.assertEqual(template.jinja2_template_name('subject'), name)
+        compiled = engine.compile_field(template, 'subject')
+        self.assertEqual(engine.render(compiled,
+                Template.template_context(admin)),
+            'Hi %s' % admin.name)
+        self.assertEqual(len(os.listdir(directory)), files)
+
+    def test_import_time(self):
+        'Test the template engines are not imported with the module'
+        output = subprocess.check_output([sys.executable, '-c',
+                'import sys\n'
+                'import trytond.modules.electronic_mail_template\n'
+                'print(\'\\n\'.join(sorted(sys.modules)))'],
+            universal_newlines=True)
+        modules = output.splitlines()
+        self.assertIn('trytond.modules.electronic_mail_template.engine',
+            modules)
+        for name in ('genshi.template', 'jinja2'):
+            self.assertNotIn(name, modules)
+
+    @with_transaction()
+    def test_missing_engine(self):
+        'Test templates render empty values without their engine package'
+        pool = Pool()
+        Template = pool.get('electronic.mail.template')
+        User = pool.get('res.user')
+
+        template = self.create_template(engine='python',
+            subject='"Hello " + record.name', plain='"Dear " + record.name',
+            html='"Dear " + record.name')
+        admin, = User.search([('login', '=', 'admin')])
+        engines = template_engine._engines
+        previous = engines.get('python')
+        engines['python'] = None
+        try:
+            Template._compiled_cache.clear()
+            self.assertEqual(template.eval(template.subject, admin), u'')
+            message = template.render(admin)
+            self.assertEqual(message['subject'], None)
+        finally:
+            engines['python'] = previous
+            Template._compiled_cache.clear()
+
+    def test_genshi_literal(self):
+        'Test Genshi expressions with directives are not literals'
+        engine = GenshiEngine()
+        self.assertEqual(engine.literal(u'admin@example.com'),
+            b'admin@example.com')
+        for expression in (u'${record.login}', u'#if True\nyes\n#end',
+                u'Hello\n  #choose\n#end', u'##'):
+            self.assertEqual(engine.literal(expression), None)
+
+    @with_transaction()
+    def test_render_program(self):
+        'Test the render program matches the field evaluation'
+        pool = Pool()
+        User = pool.get('res.user')
+
+        admin, = User.search([('login', '=', 'admin')])
+        for engine, values in (
+                ('python', {
+                        'from_': '"admin@example.com"',
+                        'to': 'record.login + "@example.com"',
+                        'subject': '"Hello " + record.name',
+                        'plain': '"Dear " + record.name # comment',
+                        'html': '"<p>%s</p>" % record.name',
+                        }),
+                ('genshi', {}),
+                ('jinja2', {
+                        'to': '{{ record.login }}@example.com',
+                        'subject': 'Hello {{ record.name }}\n',
+                        'plain': '{% set name = record.name %}{{ name }}\n',
+                        'html': '<p>{{ record.name|e }}</p>',
+                        }),
+                ):
+            template = self.create_template(engine=engine, **values)
+            program = template.get_program()
+            self.assertEqual(list(program.literals), ['from_'])
+            self.assertEqual(program.field_names,
+                ['to', 'subject', 'plain', 'html'])
+            self.assertIs(template.get_program(), program)
+            rendered = program.render(template.template_context(admin))
+            self.assertEqual(rendered['from_'], 'admin@example.com')
+            for field_name in program.field_names:
+                self.assertEqual(rendered[field_name],
+                    template.eval(getattr(template, field_name), admin,
+                        field_name))
+
+    @with_transaction()
+    def test_stats(self):
+        'Test the stages of a batch are stored when enabled'
+        pool = Pool()
+        TemplateStats = pool.get('electronic.mail.template.stats')
+        User = pool.get('res.user')
+
+        template = self.create_template()
+        users = User.search([])
+        with instrument(template) as batch_stats:
+            with stage('eval.genshi'):
+                pass
+        self.assertEqual(batch_stats, None)
+
+        if not config.has_section('electronic_mail_template'):
+            config.add_section('electronic_mail_template')
+        config.set('electronic_mail_template', 'stats', 'True')
+        try:
+            with instrument(template) as batch_stats:
+                list(template.render_many(users))
+                with stage('smtp') as smtp_stage:
+                    smtp_stage.size = 10
+        finally:
+            config.remove_option('electronic_mail_template', 'stats')
+        batch_stats.records = len(users)
+        TemplateStats.record(batch_stats)
+
+        summary = TemplateStats.summary(template)
+        self.assertEqual(set(summary), {'batch', 'eval.genshi',
+                'recipients', 'mime', 'smtp'})
+        self.assertEqual(summary['eval.genshi']['calls'], len(users))
+        self.assertEqual(summary['smtp']['bytes'], 10)
+
+    @with_transaction()
+    def test_trigger_coalescing(self):
+        'Test trigger records are sent once per template and record'
+        pool = Pool()
+        Job = pool.get('electronic.mail.template.job')
+        User = pool.get('res.user')
+
+        template = self.create_template(deferred=True)
+        users = User.search([])
+        datamanager = Transaction().join(TriggerDataManager())
+        self.assertIs(Transaction().join(TriggerDataManager()), datamanager)
+        datamanager.put(template, users)
+        datamanager.put(template, users[:1])
+        datamanager.put(template, users)
+        datamanager.flush()
+
+        jobs = Job.search([('template', '=', template.id)])
+        self.assertEqual(sorted(j.record_id for j in jobs),
+            sorted(u.id for u in users))
+        self.assertEqual(datamanager.queue, {})
+
+    @with_transaction()
+    def test_digest(self):
+        'Test digest templates render one message per recipients'
+        pool = Pool()
+        User = pool.get('res.user')
+
+        template = self.create_template(digest=True,
+            to='${record.login == "admin" and "admin" or "users"}'
+            '@example.com',
+            plain='#for r in records\n${r.login}\n#end\n')
+        users = User.search([])
+        digests = list(template.render_messages(users))
+        admin = [u for u in users if u.login == 'admin']
+        others = [u for u in users if u.login != 'admin']
+        self.assertEqual(
+            sorted(sorted(u.id for u in g) for g, _ in digests),
+            sorted(sorted(u.id for u in g) for g in (admin, others) if g))
+        for group, message in digests:
+            plain, = [p for p in message.walk()
+                if p.get_content_type() == 'text/plain']
+            self.assertEqual(plain.get_payload(decode=True),
+                ''.join('%s\n' % u.login for u in group))
+
+    @with_transaction()
+    def test_create_from_emails(self):
+        'Test a chunk of messages is stored with one create'
+        pool = Pool()
+        ElectronicMail = pool.get('electronic.mail')
+        Mailbox = pool.get('electronic.mail.mailbox')
+        User = pool.get('res.user')
+
+        mailbox, = Mailbox.create([{'name': 'Sent'}])
+        template = self.create_template()
+        users = User.search([])
+        messages = [m for _, m in template.render_many(users)]
+        mails = ElectronicMail.create_from_emails(messages, mailbox,
+            [{'bcc': 'bcc@example.com'}] * len(messages))
+        self.assertEqual(len(mails), len(users))
+        for mail, user in zip(mails, users):
+            self.assertEqual(mail.mailbox, mailbox)
+            self.assertEqual(mail.subject, 'Hello %s' % user.name)
+            self.assertEqual(mail.to, '%s@example.com' % user.login)
+            self.assertEqual(mail.bcc, 'bcc@example.com')
+
+        message = messages[0]
+        del message['to']
+        message['to'] = 'not an address'
+        self.assertRaises(UserError, ElectronicMail.create_from_emails,
+            [message], mailbox)
+
+    def create_smtp_sink(self):
+        'Returns an SMTP sink used as the server of the electronic mails'
+        pool = Pool()
+        Model = pool.get('ir.model')
+        SMTPServer = pool.get('smtp.server')
+
+        sink = SMTPSink()
+        self.addCleanup(sink.stop)
+        mail_model, = Model.search([('model', '=', 'electronic.mail')])
+        SMTPServer.create([{
+                    'name': 'Sink',
+                    'smtp_server': '127.0.0.1',
+                    'smtp_port': sink.port,
+                    'smtp_email': 'admin@example.com',
+                    'default': True,
+                    'models': [('add', [mail_model.id])],
+                    }])
+        return sink
+
+    @with_transaction()
+    def test_job_process(self):
+        'Test deferred jobs isolate the failing records'
+        pool = Pool()
+        Job = pool.get('electronic.mail.template.job')
+        Mailbox = pool.get('electronic.mail.mailbox')
+        User = pool.get('res.user')
+
+        sink = self.create_smtp_sink()
+        mailbox, = Mailbox.create([{'name': 'Sent'}])
+        template = self.create_template(deferred=True, mailbox=mailbox.id,
+            plain='${1 / (record.login != "admin")}')
+        User.create([{
+                    'name': 'User %s' % i,
+                    'login': 'user%s' % i,
+                    } for i in range(2)])
+        users = User.search([('login', 'in', ['admin', 'user0', 'user1'])],
+            order=[('id', 'ASC')])
+        Job.create_from_records(template, users)
+        with Transaction().set_context(_email_template_commit=False):
+            Job.process()
+
+        jobs = Job.search([('template', '=', template.id)])
+        states = dict((User(j.record_id).login, j.state) for j in jobs)
+        self.assertEqual(states, {
+                'admin': 'pending',
+                'user0': 'done',
+                'user1': 'done',
+                })
+        self.assertEqual(sorted(m[1] for m in sink.messages),
+            [['user0@example.com'], ['user1@example.com']])
+
+    @with_transaction()
+    def test_bulk_send_failure(self):
+        'Test the records sent before a failure are not sent again'
+        pool = Pool()
+        Bulk = pool.get('electronic.mail.template.bulk')
+        Job = pool.get('electronic.mail.template.job')
+        Mailbox = pool.get('electronic.mail.mailbox')
+        User = pool.get('res.user')
+
+        sink = self.create_smtp_sink()
+        sink.refused.add('user1@example.com')
+        mailbox, = Mailbox.create([{'name': 'Sent'}])
+        template = self.create_template(mailbox=mailbox.id)
+        user0, user1 = User.create([{
+                    'name': 'User %s' % i,
+                    'login': 'user%s' % i,
+                    } for i in range(2)])
+        with Transaction().set_context(_email_template_commit=False):
+            bulk = Bulk(template.send_bulk(ids=[user0.id, user1.id]).id)
+
+        self.assertEqual(bulk.sent, 1)
+        self.assertEqual(bulk.failed, 1)
+        self.assertEqual([m[1] for m in sink.messages],
+            [['user0@example.com']])
+        job, = Job.search([('template', '=', template.id)])
+        self.assertEqual(job.record_id, user1.id)
+        self.assertEqual(job.state, 'pending')
+        self.assertIn('451', job.error)
+
+    @with_transaction()
+    def test_bulk(self):
+        'Test bulk send checkpoint and failing records'
+        pool = Pool()
+        Bulk = pool.get('electronic.mail.template.bulk')
+        Job = pool.get('electronic.mail.template.job')
+        Mailbox = pool.get('electronic.mail.mailbox')
+        User = pool.get('res.user')
+
+        mailbox, = Mailbox.create([{'name': 'Outbox'}])
+        template = self.create_template(queue=True, mailbox=mailbox.id,
+            mailbox_outbox=mailbox.id,
+            plain='${1 / (record.login != "admin")}')
+        users = User.search([], order=[('id', 'ASC')])
+        with Transaction().set_context(_email_template_commit=False):
+            bulk = Bulk(template.send_bulk([]).id)
+        self.assertEqual(bulk.state, 'done')
+        self.assertEqual(bulk.position, len(users))
+        self.assertEqual(bulk.last_id, users[-1].id)
+        self.assertEqual(bulk.failed, 1)
+        self.assertEqual(bulk.sent, len(users) - 1)
+        job, = Job.search([('template', '=', template.id)])
+        self.assertEqual(User(job.record_id).login, 'admin')
+        self.assertEqual(job.state, 'pending')
+        self.assertIn('ZeroDivisionError', job.error)
+
+        bulk, = Bulk.create([{
+                    'template': template.id,
+                    'position': 1,
+                    }])
+        with Transaction().set_context(_email_template_commit=False):
+            bulk.run(iter([u.id for u in users]), chunk_size=1)
+        bulk = Bulk(bulk.id)
+        self.assertEqual(bulk.state, 'done')
+        self.assertEqual(bulk.position, len(users))
+        self.assertEqual(bulk.sent + bulk.failed, len(users) - 1)
+
+    def test_normalize_recipients(self):
+        'Test recipients are validated, normalized and deduplicated'
+        self.assertEqual(normalize_recipients(
+                'Admin <admin@Example.COM>, bad, admin@example.com',
+                'ADMIN@example.com, user@example.com',
+                'user@EXAMPLE.com, bcc@example.com'),
+            ('Admin <admin@example.com>', 'user@example.com',
+                'bcc@example.com', ['bad']))
+        self.assertEqual(normalize_recipients(None, ''),
+            (None, None, None, []))
+        self.assertEqual(normalize_recipients(
+                'a@example.com; "Doe; J" <j@example.com>'),
+            ('a@example.com, "Doe; J" <j@example.com>', None, None, []))
+        self.assertEqual(normalize_recipients(u'user@b\xfccher.de'),
+            (u'user@xn--bcher-kva.de', None, None, []))
+        self.assertEqual(normalize_recipients(
+                u'user@\u043f\u0440\u0438\u043c\u0435\u0440.\u0440\u0444'),
+            (u'user@xn--e1afmkfd.xn--p1ai', None, None, []))
+
+    @with_transaction()
+    def test_invalid_recipients(self):
+        'Test invalid recipients are rejected or quarantined'
+        pool = Pool()
+        User = pool.get('res.user')
+
+        template = self.create_template(
+            to='${record.login}@example.com'
+            '${record.login == "admin" and "@" or ""}')
+        admin, = User.search([('login', '=', 'admin')])
+        self.assertRaises(UserError, template.render, admin)
+        users = User.search([])
+        quarantine = []
+        rendered = list(template.render_many(users, quarantine))
+        self.assertEqual([r for r, _ in rendered],
+            [u for u in users if u != admin])
+        self.assertEqual(quarantine, [(admin, ['admin@example.com@'])])
+
+    @with_transaction()
+    def test_preview(self):
+        'Test preview renders without storing the mails'
+        pool = Pool()
+        ElectronicMail = pool.get('electronic.mail')
+        User = pool.get('res.user')
+
+        template = self.create_template()
+        mails = ElectronicMail.search([], count=True)
+        users = User.search([])
+        preview = template.preview(domain=[], limit=1)
+        message, = preview['messages']
+        self.assertEqual(message['records'], [users[0].id])
+        self.assertEqual(message['headers']['to'],
+            '%s@example.com' % users[0].login)
+        self.assertEqual(message['plain'],
+            len('Dear %s' % users[0].name))
+        self.assertEqual(message['attachments'], [])
+        self.assertIn('mime', preview['stats']['stages'])
+        self.assertIn('serialize', preview['stats']['stages'])
+        self.assertEqual(preview['quarantined'], [])
+        self.assertEqual(ElectronicMail.search([], count=True), mails)
+
+        preview = template.preview(users, reports=False)
+        self.assertEqual(len(preview['messages']), len(users))
+
+    @with_transaction()
+    def test_render_many(self):
+        'Test render_many matches render'
+        pool = Pool()
+        User = pool.get('res.user')
+
+        template = self.create_template()
+        users = User.search([])
+        rendered = list(template.render_many(users))
+        self.assertEqual([r for r, _ in rendered], users)
+        for user, message in rendered:
+            expected = template.render(user)
+            for header in ('from', 'to', 'subject'):
+                self.assertEqual(message[header], expected[header])
+
+    @with_transaction()
+    def test_execute_many(self):
+        'Test execute_many reports are split per record and cached'
+        pool = Pool()
+        User = pool.get('res.user')
+
+        action, remove = add_batch_report('res.user')
+        self.addCleanup(remove)
+        template = self.create_template(reports=[('add', [action.id])])
+        User.create([{
+                    'name': 'User %s' % i,
+                    'login': 'user%s' % i,
+                    } for i in range(3)])
+        users = User.search([], order=[('id', 'ASC')])
+        ids = [u.id for u in users]
+
+        BatchReport.calls = []
+        reports = template.render_reports_many(users)
+        self.assertEqual(BatchReport.calls, [ids])
+        for user in users:
+            self.assertEqual(reports[user.id], [('txt',
+                        ('Report %s' % user.id).encode('ascii'), 'Report',
+                        None)])
+            self.assertEqual(reports[user.id], template.render_reports(user))
+
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        database_path = config.get('database', 'path')
+        if not config.has_section('electronic_mail_template'):
+            config.add_section('electronic_mail_template')
+        config.set('electronic_mail_template', 'report_cache_size', '1')
+        config.set('database', 'path', directory)
+        try:
+            BatchReport.calls = []
+            template.render_reports_many(users[:1])
+            cached = template.render_reports_many(users)
+            User.write(users[-1:], {'name': 'Modified'})
+            users = User.search([], order=[('id', 'ASC')])
+            self.assertEqual(template.render_reports_many(users), cached)
+        finally:
+            config.set('database', 'path', database_path)
+            config.remove_option('electronic_mail_template',
+                'report_cache_size')
+            template_module._report_caches.clear()
+        self.assertEqual(cached, reports)
+        self.assertEqual(BatchReport.calls,
+            [ids[:1], ids[1:], ids[-1:]])
+
+    @with_transaction()
+    def test_prefetch_paths(self):
+        'Test prefetch paths'
+        pool = Pool()
+        Lang = pool.get('ir.lang')
+        Template = pool.get('electronic.mail.template')
+        User = pool.get('res.user')
+
+        lang, = Lang.search([('code', '=', Transaction().language)])
+        User.create([{
+                    'name': 'User',
+                    'login': 'user',
+                    }])
+        User.write(User.search([]), {
+                'language': lang.id,
+                })
+        template = self.create_template(
+            prefetch='groups.name\n\nlanguage',
+            plain='${record.groups[0].name} ${record.language.code}')
+        self.assertEqual(template.get_prefetch_paths(), [
+                'groups.name', 'language', 'login', 'name',
+                'language.code'])
+
+        reads = []
+
+        def count_reads(Model):
+            original = Model.__dict__.get('read')
+            read = Model.read.__func__
+
+            def counted(cls, ids, fields_names=None):
+                reads.append((cls.__name__, len(ids)))
+                return read(cls, ids, fields_names=fields_names)
+
+            def restore():
+                if original is None:
+                    del Model.read
+                else:
+                    Model.read = original
+            Model.read = classmethod(counted)
+            self.addCleanup(restore)
+        for model in ('res.group', 'ir.lang'):
+            count_reads(pool.get(model))
+
+        users = User.search([])
+        template.prefetch_records(users)
+        self.assertEqual(sorted(m for m, _ in reads),
+            ['ir.lang', 'res.group'])
+
+        # Each language context is prefetched, the transaction cache
+        # depends on it
+        Template.write([template], {
+                'language': '${record.login == "admin" and "fr" or "en"}',
+                })
+        template = Template(template.id)
+        del reads[:]
+        messages = list(template.render_many(users))
+        self.assertEqual(sorted(r.id for r, _ in messages),
+            sorted(u.id for u in users))
+        self.assertEqual(sorted(m for m, _ in reads),
+            ['ir.lang', 'ir.lang', 'res.group', 'res.group'])
+
+    @with_transaction()
+    def test_render_parallel(self):
+        'Test the chunks rendered in process match the serial rendering'
+        pool = Pool()
+        User = pool.get('res.user')
+
+        def normalize(message):
+            del message['date']
+            return [(part.items(), part.get_payload(decode=True))
+                for part in message.walk() if not part.is_multipart()]
+
+        template = self.create_template()
+        users = User.search([])
+        serial = dict((r.id, normalize(m))
+            for r, m in template.render_many(users))
+        parallel = dict((r.id, normalize(m))
+            for r, m in template.render_parallel(users, processes=1,
+                chunk_size=1))
+        self.assertEqual(parallel, serial)
+
+    @unittest.skipIf(DB_NAME == ':memory:',
+        'the workers do not share a memory database')
+    @with_transaction()
+    def test_render_worker(self):
+        'Test the worker processes render as the serial path'
+        pool = Pool()
+        Template = pool.get('electronic.mail.template')
+        User = pool.get('res.user')
+        transaction = Transaction()
+
+        def normalize(message):
+            del message['date']
+            return [(part.items(), part.get_payload(decode=True))
+                for part in message.walk() if not part.is_multipart()]
+
+        # The workers only see committed data
+        template = self.create_template()
+        transaction.commit()
+        try:
+            users = User.search([])
+            serial = dict((r.id, normalize(m))
+                for r, m in template.render_many(users))
+            parallel = dict((r.id, normalize(m))
+                for r, m in template.render_parallel(users, processes=2,
+                    chunk_size=1))
+            self.assertEqual(parallel, serial)
+        finally:
+            Template.delete([template])
+            transaction.commit()
+
+    @with_transaction()
+    def test_attachment_part(self):
+        'Test identical attachments are encoded once'
+        pool = Pool()
+        Template = pool.get('electronic.mail.template')
+
+        encoded = {}
+        first = Template.attachment_part('terms.pdf', b'%PDF-1.4', encoded)
+        second = Template.attachment_part('terms.pdf', b'%PDF-1.4', encoded)
+        self.assertEqual(len(encoded), 1)
+        self.assertIs(first.get_payload(), second.get_payload())
+        self.assertEqual(first.as_string(),
+            Template.attachment_part('terms.pdf', b'%PDF-1.4').as_string())
+        self.assertEqual(second.as_string(), first.as_string())
+
+    @with_transaction()
+    def test_write_message(self):
+        'Test streaming message generation matches the in memory one'
+        pool = Pool()
+        Template = pool.get('electronic.mail.template')
+
+        def message(attachments):
+            message = MIMEMultipart()
+            message['subject'] = 'Test'
+            for filename, data in attachments:
+                attachment = Template.attachment_part(filename, data)
+                attachment.add_header('Content-Transfer-Encoding', 'base64')
+                message.attach(attachment)
+            body = MIMEMultipart('alternative')
+            body.attach(MIMEText('Plain'))
+            body.attach(MIMEText('<p>HTML</p>', 'html'))
+            message.attach(body)
+            message.set_boundary('boundary')
+            body.set_boundary('body')
+            return message
+
+        attachments = [
+            ('report.pdf', os.urandom(200 * 1024)),
+            ('empty.txt', b''),
+            ]
+        fileobj = Template.write_message(message([]), attachments)
+        self.assertEqual(fileobj.read(), message(attachments).as_string())
+
+    @with_transaction()
+    def test_render_stream(self):
+        'Test streaming a template with a report matches render'
+        pool = Pool()
+        User = pool.get('res.user')
+
+        def normalize(message):
+            headers = [(k, v) for k, v in message.items()
+                if k.lower() not in ('date', 'content-type')]
+            return headers, [(part.items(), part.get_payload(decode=True))
+                for part in message.walk() if not part.is_multipart()]
+
+        action, remove = add_batch_report('res.user')
+        self.addCleanup(remove)
+        template = self.create_template(reports=[('add', [action.id])])
+        admin, = User.search([('login', '=', 'admin')])
+        expected = template.render(admin)
+        streamed = message_from_string(
+            template.render_stream(admin).read())
+        self.assertEqual(normalize(streamed), normalize(expected))
+        self.assertIn(('Report %s' % admin.id).encode('ascii'),
+            [p.get_payload(decode=True) for p in streamed.walk()])
+
+    @with_transaction()
+    def test_html_wrapper(self):
+        'Test HTML wrapper from the style registry'
+        template = self.create_template(style='simples.css',
+            custom_style='p {color: red;}')
+        with open(os.path.join(os.path.dirname(__file__), '..', 'styles',
+                    'simples.css')) as f:
+            style = f.read() + '\np {color: red;}'
+        prefix, suffix = template.get_html_wrapper()
+        self.assertEqual(prefix + '<p>Body</p>' + suffix, """
+                <html>
+                <head><head>
+                <style>
+                %s
+                </style>
+                <body>
+                %s
+                </body>
+                </html>
+                """ % (style, '<p>Body</p>'))
+        self.assertEqual(template.get_html_wrapper(), (prefix, suffix))
+
+    @with_transaction()
+    def test_job_postpone(self):
+        'Test deferred jobs backoff and dead-lettering'
+        pool = Pool()
+        Job = pool.get('electronic.mail.template.job')
+        User = pool.get('res.user')
+
+        template = self.create_template(deferred=True)
+        admin, = User.search([('login', '=', 'admin')])
+        job, = Job.create_from_records(template, [admin])
+        self.assertEqual(job.state, 'pending')
+
+        next_try = None
+        for attempt in range(1, 5):
+            Job.postpone([job], 'Error')
+            job = Job(job.id)
+            self.assertEqual(job.state, 'pending')
+            self.assertEqual(job.attempts, attempt)
+            if next_try:
+                self.assertGreater(job.next_try, next_try)
+            next_try = job.next_try
+        Job.postpone([job], 'Error')
+        job = Job(job.id)
+        self.assertEqual(job.state, 'failed')
+
+        Job.retry([job])
+        job = Job(job.id)
+        self.assertEqual(job.state, 'pending')
+        self.assertEqual(job.attempts, 0)
+
+
+class SMTPSessionTestCase(unittest.TestCase):
+    'Test SMTP session'
+
+    def setUp(self):
+        self.sink = SMTPSink()
+
+    def tearDown(self):
+        self.sink.stop()
+
+    def test_connection_reuse(self):
+        'Test messages share the SMTP connections'
+        with SMTPSession(self.sink.connect, max_messages=2) as session:
+            for i in range(5):
+                session.sendmail('from@example.com', ['to@example.com'],
+                    'Subject: %s\n\nBody' % i)
+        self.assertEqual(session.stats(), {
+                'connections': 3,
+                'messages': 5,
+                })
+        self.assertEqual(len(self.sink.messages), 5)
+
+    def test_reconnect(self):
+        'Test the session reconnects when the connection is dropped'
+        with SMTPSession(self.sink.connect) as session:
+            session.sendmail('from@example.com', ['to@example.com'],
+                'Subject: 1\n\nBody')
+            session._server.close()
+            session.sendmail('from@example.com', ['to@example.com'],
+                'Subject: 2\n\nBody')
+        self.assertEqual(session.stats(), {
+                'connections': 2,
+                'messages': 2,
+                })
+        self.assertEqual(len(self.sink.messages), 2)
+
+
+class OutboxDrainTestCase(unittest.TestCase):
+    'Test outbox drain'
+
+    def setUp(self):
+        self.sink = SMTPSink()
+
+    def tearDown(self):
+        self.sink.stop()
+
+    def test_drain(self):
+        'Test messages are sent over the pooled connections at the rate'
+        drain = OutboxDrain(smtp_connector('127.0.0.1', self.sink.port),
+            rate=50, concurrency=2, max_messages=3)
+        messages = [(i, 'from@example.com', ['to@example.com'],
+                'Subject: %s\n\nBody' % i) for i in range(10)]
+        start = time.time()
+        results = drain.send(messages)
+        duration = time.time() - start
+        drain.close()
+        self.assertEqual(results, dict((i, None) for i in range(10)))
+        self.assertGreaterEqual(duration, 9 / 50.)
+        # Renewed after 3 messages in the threads
+        self.assertGreater(drain.stats()['connections'], 2)
+        self.assertEqual(len(self.sink.messages), 10)
+
+    def test_unavailable_relay(self):
+        'Test messages are deferred when the relay is unavailable'
+        def connect():
+            raise socket.error('Connection refused')
+        drain = OutboxDrain(connect)
+        results = drain.send([(1, 'from@example.com', ['to@example.com'],
+                    'Subject: 1\n\nBody')])
+        self.assertTrue(results[1][1])
+        self.assertGreater(drain.limiter.delay, 0)
+
+    def test_backpressure(self):
+        'Test the rate limiter delay is doubled and halved'
+        now = [0.]
+        sleeps = []
+
+        def sleep(seconds):
+            sleeps.append(seconds)
+            now[0] += seconds
+        limiter = RateLimiter(rate=10, max_delay=1., clock=lambda: now[0],
+            sleep=sleep)
+        limiter.wait()
+        limiter.wait()
+        self.assertEqual(sleeps, [0.1])
+        for delay in (0.05, 0.1, 0.2, 0.4, 0.8, 1., 1.):
+            limiter.slow_down()
+            self.assertAlmostEqual(limiter.delay, delay)
+        limiter.wait()
+        self.assertAlmostEqual(sleeps[-1], 0.1)
+        limiter.wait()
+        self.assertAlmostEqual(sleeps[-1], 1.1)
+        for delay in (0.5, 0.25, 0.125, 0.0625, 0.):
+            limiter.speed_up()
+            self.assertAlmostEqual(limiter.delay, delay)
+
+
+class FileCacheTestCase(unittest.TestCase):
+    'Test file cache'
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_get_set(self):
+        'Test file cache get and set'
+        cache = FileCache(self.directory, 1024 * 1024)
+        self.assertEqual(cache.get('key'), None)
+        cache.set('key', ('pdf', b'data', False, 'Report'))
+        self.assertEqual(cache.get('key'), ('pdf', b'data', False, 'Report'))
+        self.assertEqual(cache.stats()['hits'], 1)
+        self.assertEqual(cache.stats()['misses'], 1)
+
+    def test_eviction(self):
+        'Test file cache evicts the least recently used entries'
+        cache = FileCache(self.directory, 2500)
+        cache.set('first', b'x' * 1000)
+        cache.set('second', b'x' * 1000)
+        past = time.time() - 60
+        os.utime(cache._path('second'), (past, past))
+        cache.get('first')
+        cache.set('third', b'x' * 1000)
+        self.assertEqual(cache.get('second'), None)
+        self.assertEqual(cache.get('first'), b'x' * 1000)
+        self.assertEqual(cache.get('third'), b'x' * 1000)
+
 
 def suite():
     suite = trytond.tests.test_tryton.suite()
     suite.addTests(unittest.TestLoader().loadTestsFromTestCase(
         ElectronicMailTemplateTestCase))
+    suite.addTests(unittest.TestLoader().loadTestsFromTestCase(
+        SMTPSessionTestCase))
+    suite.addTests(unittest.TestLoader().loadTestsFromTestCase(
+        OutboxDrainTestCase))
+    suite.addTests(unittest.TestLoader().loadTestsFromTestCase(
+        FileCacheTestCase))
     return suite
@@ -3,6 +3,8 @@
 #The COPYRIGHT file at the top level of this repository contains 
 #the full copyright notices and license terms.
 "Trigger Extension"
+from collections import OrderedDict
+
 from trytond.model import fields
 from trytond.transaction import Transaction
 from trytond.pool import Pool, PoolMeta
@@ -46,3 +48,74 @@ class Trigger:
         """
         email_trigger = Transaction().context.get('email_template', False)
         return email_trigger and 'mail_from_trigger' or None
+
+
+class TriggerDataManager(object):
+    """Collects the records of the email template triggers fired in a
+    transaction and sends them at commit in one batch per template, once per
+    record whatever the number of times it was triggered
+    """
+
+    def __init__(self):
+        self.queue = OrderedDict()
+
+    def __eq__(self, other):
+        return isinstance(other, TriggerDataManager)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def put(self, template, records):
+        keys = self.queue.setdefault(template.id, OrderedDict())
+        for record in records:
+            keys[(record.__name__, record.id)] = True
+
+    def flush(self):
+        """Sends the collected records, or records jobs for the deferred
+        templates, including those of the triggers fired while sending
+        """
+        pool = Pool()
+        Template = pool.get('electronic.mail.template')
+        Job = pool.get('electronic.mail.template.job')
+        transaction = Transaction()
+
+        while self.queue:
+            template_id, keys = self.queue.popitem(last=False)
+            template = Template(template_id)
+            models = OrderedDict()
+            for model, record_id in keys:
+                models.setdefault(model, []).append(record_id)
+            for model, ids in models.items():
+                Model = pool.get(model)
+                # Skip the records deleted after the trigger
+                with transaction.set_context(active_test=False):
+                    records = Model.search([('id', 'in', ids)])
+                position = dict((i, p) for p, i in enumerate(ids))
+                records.sort(key=lambda r: position[r.id])
+                if not records:
+                    continue
+                if template.deferred:
+                    Job.create_from_records(template, records)
+                    continue
+                # The worker processes would not see the data of this
+                # transaction
+                with transaction.set_context(_email_template_parallel=False):
+                    template.render_and_send(records)
+
+    def abort(self, trans):
+        self.queue.clear()
+
+    def tpc_begin(self, trans):
+        pass
+
+    def commit(self, trans):
+        self.flush()
+
+    def tpc_vote(self, trans):
+        pass
+
+    def tpc_finish(self, trans):
+        self.queue.clear()
+
+    def tpc_abort(self, trans):
+        self.queue.clear()